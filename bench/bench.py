@@ -0,0 +1,187 @@
+'''
+Benchmarks of parsing, preprocessing, training and classification on
+synthetic corpora, results are written to JSON so that runs on different
+commits can be compared with --compare.
+
+    cd bench && python3 bench.py --sizes 1000 10000 --out result.json
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synth import gen_corpus
+from dataloader import parse_email
+from classifier import NaiveBayesClassifier
+import preprocess
+
+
+_file = f'[{os.path.basename(__file__)}]'
+
+
+def timed(fn, *args, **kwargs) -> tuple:
+    '''
+    Return (result of fn, seconds)
+    '''
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_parse(examples: list) -> tuple:
+    paths = [path for path, _ in examples]
+    num_bytes = sum(os.path.getsize(path) for path in paths)
+    emails, secs = timed(lambda: [parse_email(path) for path in paths])
+    for email, (_, label) in zip(emails, examples):
+        email['label'] = label
+    result = {
+        'seconds': secs,
+        'mb_per_sec': num_bytes / 2**20 / secs,
+        'us_per_email': 1e6 * secs / len(paths),
+    }
+    return emails, result
+
+
+def bench_stats(emails: list) -> tuple:
+    '''
+    All statistics are counted in one CorpusStats pass, timed once, then
+    each statistic is read from the counts
+    '''
+    result = {}
+    stats, result['corpus_stats'] = timed(preprocess.CorpusStats().update, emails)
+    for name in ('get_words', 'get_idf', 'get_label_cnts', 'get_label_ip_cnts', 'get_label_time_cnts'):
+        _, result[name] = timed(getattr(stats, name))
+    return stats, result
+
+
+def bench_classifier(stats, train: list, dev: list) -> dict:
+    result = {}
+    words_all, words_0, words_1 = stats.get_words()
+    classifier, result['init'] = timed(
+        NaiveBayesClassifier,
+        stats.get_label_cnts(),
+        words_all,
+        {0: words_0, 1: words_1},
+        stats.get_label_ip_cnts(),
+        stats.get_label_time_cnts(),
+        stats.get_idf(),
+        use_ip=True,
+        use_time=True)
+    _, result['pre_compute'] = timed(classifier.pre_compute)
+
+    latencies = []
+    for email in dev:
+        _, secs = timed(classifier.classify, email)
+        latencies.append(secs)
+    latencies = np.array(latencies) * 1e6
+    result['classify_us_p50'] = float(np.percentile(latencies, 50))
+    result['classify_us_p99'] = float(np.percentile(latencies, 99))
+    result['classify_per_sec'] = len(dev) / (latencies.sum() / 1e6)
+
+    _, secs = timed(classifier.classify_batch, dev)
+    result['classify_batch_per_sec'] = len(dev) / secs
+
+    _, secs = timed(classifier.partial_fit, train[:len(dev)])
+    result['partial_fit_per_sec'] = len(dev) / secs
+    return result
+
+
+def run(size: int, seed: int) -> dict:
+    print(_file, f'Corpus of {size} emails')
+    with tempfile.TemporaryDirectory() as root:
+        examples, gen_secs = timed(gen_corpus, root, size, seed)
+        print(_file, f'  generated in {gen_secs:.2f}s')
+        emails, parse = bench_parse(examples)
+    split = len(emails) * 4 // 5
+    train, dev = emails[:split], emails[split:]
+    stats, stats_result = bench_stats(train)
+    return {
+        'num_emails': size,
+        'vocab_size': len(stats.vocab),
+        'parse': parse,
+        'preprocess': stats_result,
+        'classifier': bench_classifier(stats, train, dev),
+    }
+
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip()
+    except OSError:
+        return ''
+
+
+def flatten(d: dict, prefix='') -> dict:
+    flat = {}
+    for key, val in d.items():
+        if isinstance(val, dict):
+            flat.update(flatten(val, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = val
+    return flat
+
+
+def compare(old: dict, new: dict) -> None:
+    '''
+    Print new / old for every metric of the sizes in both results
+    '''
+    old_runs = {run['num_emails']: flatten(run) for run in old['runs']}
+    for run in new['runs']:
+        size = run['num_emails']
+        if size not in old_runs:
+            continue
+        print(f'--- {size} emails: {old["commit"]} -> {new["commit"]} ---')
+        for key, val in flatten(run).items():
+            old_val = old_runs[size].get(key)
+            if key == 'num_emails' or not old_val:
+                continue
+            print(f'{key:45s} {old_val:12.4g} {val:12.4g}  x{val / old_val:.2f}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--sizes',
+        help='number of emails of each synthetic corpus',
+        type=int,
+        nargs='+',
+        default=[1000, 10000])
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--out',
+        help='file to write the results to (JSON)',
+        default='bench_result.json')
+    parser.add_argument(
+        '--compare',
+        help='results (JSON) of an earlier run to compare with')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    result = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'runs': [run(size, args.seed) for size in args.sizes],
+    }
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(_file, 'Results written to', args.out)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
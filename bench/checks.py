@@ -0,0 +1,220 @@
+'''
+Checks of edge cases of the counts and scores on tiny hand-made corpora,
+each check raises AssertionError on failure.
+
+    cd bench && python3 checks.py
+'''
+import os
+import sys
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from preprocess import CorpusStats
+from classifier import NaiveBayesClassifier
+from vocab import Vocabulary, MappedVocabulary
+
+
+_file = f'[{os.path.basename(__file__)}]'
+
+
+def email(label, words, ip=None, hour=None) -> dict:
+    return {'label': label, 'words': {word: 1 for word in words}, 'ip': ip, 'hour': hour}
+
+
+def check_ip_without_ipv4() -> None:
+    '''
+    IP scores are finite when no training email has an IPv4 IP
+    '''
+    for ips in ([None, None], [None, 'not.an.ip'], ['::1', '999.1.2.3']):
+        train = [email(1, ['buy', 'now'], ips[0], 3), email(0, ['hello'], ips[1])]
+        classifier = CorpusStats().update(train).build_classifier(use_ip=True)
+        test = [email(1, ['buy'], '1.2.3.4'), email(0, ['hello'], None)]
+        scores = classifier.score_batch(test)
+        assert np.isfinite(scores).all(), (ips, scores)
+        assert [classifier.classify(e) for e in test] == [1, 0], ips
+
+
+def check_hash_collisions() -> None:
+    '''
+    Words of an email in the same hash bucket count the email once, so
+    document frequencies never exceed the number of emails
+    '''
+    train = [email(1, ['buy', 'now', 'cheap']), email(0, ['hello', 'now'])]
+    stats = CorpusStats(1).update(train)
+    assert stats.word_cnts.tolist() == [2], stats.word_cnts
+    assert [cnts.tolist() for cnts in stats.label_word_cnts.values()] == [[1], [1]]
+    classifier = stats.build_classifier()
+    assert (classifier.idf >= 0).all(), classifier.idf
+
+    # Also when learning emails online
+    classifier.partial_fit([email(1, ['free', 'money'])])
+    assert classifier.global_word_cnts.tolist() == [3], classifier.global_word_cnts
+
+
+def check_early_exit() -> None:
+    '''
+    classify_early_exit gives the label of classify, also when the IP
+    outweighs the words
+    '''
+    train = [email(1, ['buy', 'now'], '1.2.3.4', 3), email(1, ['cheap', 'now'], '1.2.3.5'),
+             email(0, ['hello', 'now'], '5.6.7.8', 9), email(0, ['meeting'], '5.6.7.9')]
+    test = [email(None, words, ip, hour) for words in (['buy'], ['hello'], ['now'], [])
+            for ip in ('1.2.3.4', '1.2.9.9', '5.6.7.8', '9.9.9.9', None) for hour in (3, None)]
+    for ip_weight in (0.1, 1, 10):
+        classifier = CorpusStats().update(train).build_classifier(
+            smooth_factor=0.01, use_ip=True, use_time=True, ip_weight=ip_weight)
+        for e in test:
+            label, _ = classifier.classify_early_exit(e)
+            assert label == classifier.classify(e), (ip_weight, e)
+
+
+def check_batch_features() -> None:
+    '''
+    classify_batch gives the labels of classify when emails have more
+    words than num_features, and with IPs that are not IPv4
+    '''
+    train = [email(1, ['buy', 'now', 'cheap', 'pills'], '1.2.3.4', 3),
+             email(1, ['cheap', 'now', 'offer'], '999.1.2.3'),
+             email(0, ['hello', 'now', 'meeting', 'notes'], '5.6.7.8', 9),
+             email(0, ['meeting', 'lunch'], '5.6.7.9')]
+    words = ['buy', 'hello', 'now', 'cheap', 'meeting', 'unseen', 'notes', 'offer']
+    test = [email(None, words[i:] + words[:i], ip, hour) for i in range(len(words))
+            for ip in ('1.2.3.4', '1.2.9.9', '5.6.7.8', '999.1.2.3', '::1', None)
+            for hour in (3, None)]
+    for num_features in (1, 3, 100):
+        classifier = CorpusStats().update(train).build_classifier(
+            smooth_factor=0.01, use_ip=True, use_time=True, num_features=num_features)
+        assert classifier.classify_batch(test) == [classifier.classify(e) for e in test], \
+            num_features
+
+
+def check_partial_fit() -> None:
+    '''
+    partial_fit of emails gives the scores and feature ranking of a model
+    trained on them, also with new words, IPs and subnets
+    '''
+    train = [email(1, ['buy', 'now', 'cheap'], '1.2.3.4', 3),
+             email(0, ['hello', 'now'], '5.6.7.8', 9),
+             email(1, ['cheap', 'pills', 'buy'], '1.2.9.9'),
+             email(0, ['meeting', 'notes'], '5.6.7.8'),
+             email(1, ['free', 'pills'], '8.8.8.8', 3),
+             email(0, ['lunch', 'now', 'free'], '::1', 9)]
+    test = [email(None, ['buy', 'free', 'hello', 'lunch', 'unseen'], ip, 3)
+            for ip in ('1.2.3.4', '1.2.7.7', '8.8.8.8', '9.9.9.9', None)]
+    kwargs = {'smooth_factor': 0.01, 'use_ip': True, 'use_time': True, 'num_features': 2}
+    full = CorpusStats().update(train).build_classifier(**kwargs)
+    classifier = CorpusStats().update(train[:2]).build_classifier(**kwargs)
+    classifier.score_batch(test)
+    for e in train[2:]:
+        classifier.partial_fit([e])
+        classifier.classify(test[0])
+    assert np.allclose(classifier.score_batch(test), full.score_batch(test))
+    assert [classifier.extract_features(e['words']) for e in test] \
+        == [full.extract_features(e['words']) for e in test]
+
+
+
+def check_forget() -> None:
+    '''
+    forget undoes partial_fit, also for new words, IPs and hours, and
+    refuses to forget all the emails of a label
+    '''
+    train = [email(1, ['buy', 'now', 'cheap'], '1.2.3.4', 3),
+             email(0, ['hello', 'now'], '5.6.7.8', 9),
+             email(1, ['cheap', 'pills'], '1.2.9.9', 3),
+             email(0, ['meeting', 'notes'], '5.6.7.8', 9)]
+    extra = [email(1, ['free', 'pills', 'winner'], '8.8.8.8', 4),
+             email(0, ['lunch', 'now', 'free'], '5.6.1.1', 10)]
+    test = [email(None, ['buy', 'free', 'hello', 'lunch', 'winner', 'unseen'], ip, hour)
+            for ip in ('1.2.3.4', '8.8.8.8', '5.6.1.1', None) for hour in (3, 4, None)]
+    kwargs = {'smooth_factor': 0.01, 'use_ip': True, 'use_time': True, 'num_features': 3}
+    classifier = CorpusStats().update(train).build_classifier(**kwargs)
+    scores = classifier.score_batch(test)
+    features = [classifier.extract_features(e['words']) for e in test]
+    classifier.partial_fit(extra)
+    classifier.forget(extra)
+    assert np.allclose(classifier.score_batch(test), scores)
+    assert [classifier.extract_features(e['words']) for e in test] == features
+    classifier.ip_index = None
+    assert np.allclose(classifier.score_batch(test), scores)
+
+    try:
+        classifier.forget(train[1::2])
+    except ValueError:
+        pass
+    else:
+        assert False, 'forgot all the emails of label 0'
+    assert np.allclose(classifier.score_batch(test), scores)
+
+
+def check_mapped_vocab() -> None:
+    '''
+    MappedVocabulary gives the ids of Vocabulary, also for words sharing
+    slots of its hash table, and a saved model scores the same once
+    loaded, after partial_fit too
+    '''
+    words = [f'w{i}' for i in range(5000)] + ['caf\u00e9', 'a', 'ab']
+    vocab = Vocabulary(words)
+    mapped = MappedVocabulary.from_words(words)
+    queries = words + [word + 'x' for word in words] + ['', 'caf']
+    for _ in range(2):  # then from its cache
+        assert (mapped.lookup(queries, len(words)) == vocab.lookup(queries, len(words))).all()
+    assert [mapped.get(word) for word in queries] == [vocab.get(word) for word in queries]
+    assert list(mapped) == words and len(mapped) == len(vocab)
+    assert len(MappedVocabulary.from_words([]).lookup(['a'])) == 1
+
+    # Hours are strings as in parse_email, they are JSON keys in the file
+    train = [email(1, ['buy', 'now', 'cheap'], '1.2.3.4', '3'),
+             email(0, ['hello', 'now'], '5.6.7.8', '9'),
+             email(1, ['cheap', 'pills'], '1.2.9.9', '3')]
+    test = [email(None, ['buy', 'hello', 'pills', 'free', 'unseen'], '1.2.3.4', hour)
+            for hour in ('3', '9', '12')]
+    kwargs = {'smooth_factor': 0.01, 'use_ip': True, 'use_time': True}
+    classifier = CorpusStats().update(train).build_classifier(**kwargs)
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, 'model.nbm')
+        classifier.save(filename)
+        loaded = NaiveBayesClassifier.load(filename, **kwargs)
+        assert isinstance(loaded.vocab, MappedVocabulary)
+        assert np.allclose(loaded.score_batch(test), classifier.score_batch(test))
+        extra = [email(0, ['free', 'lunch'], '5.6.7.8', '9')]
+        classifier.partial_fit(extra)
+        loaded.partial_fit(extra)
+        assert np.allclose(loaded.score_batch(test), classifier.score_batch(test))
+
+
+def check_hour_scores() -> None:
+    '''
+    log P(hour|C) comes from the hour counts of the label, hours never seen
+    with the label score as unseen
+    '''
+    train = [email(1, ['buy'], hour='3'), email(1, ['cheap'], hour='3'),
+             email(0, ['hello'], hour='9')]
+    classifier = CorpusStats().update(train).build_classifier(smooth_factor=0.01, use_time=True)
+    classifier.pre_compute()
+    assert classifier.calc_logp_time_label('3', 1) > classifier.calc_logp_time_label('9', 1)
+    assert classifier.calc_logp_time_label('9', 0) > classifier.calc_logp_time_label('3', 0)
+    assert classifier.calc_logp_time_label('12', 1) == classifier.calc_logp_time_label('9', 1)
+    test = [email(None, ['buy', 'hello'], hour=hour) for hour in ('3', '9')]
+    labels = classifier.classify_batch(test)
+    assert list(labels) == [classifier.classify(e) for e in test] == [1, 0]
+
+
+CHECKS = [
+    check_ip_without_ipv4,
+    check_hash_collisions,
+    check_early_exit,
+    check_batch_features,
+    check_partial_fit,
+    check_forget,
+    check_mapped_vocab,
+    check_hour_scores,
+]
+
+
+if __name__ == '__main__':
+    for check in CHECKS:
+        check()
+        print(_file, check.__name__, 'OK')
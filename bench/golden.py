@@ -0,0 +1,134 @@
+'''
+Golden check of dataloader.parse_email against the original line-by-line
+parser kept below: both must give the same words, IP and hour on every
+email of a corpus. Also prints MB/s of both.
+
+    cd bench && python3 golden.py                 # trec06p (data/trec06p/index)
+    cd bench && python3 golden.py --synth 10000   # synthetic corpus
+'''
+import os
+import re
+import sys
+import codecs
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synth import gen_corpus
+from bench import timed
+from config import TOKEN_URL, TOKEN_EMAIL, TOKEN_SYMBOLS
+from utils import incr
+import dataloader
+
+
+_file = f'[{os.path.basename(__file__)}]'
+
+
+# Original parser, do not change
+re_received = re.compile(r'received: from.*')
+re_date = re.compile(r'date: .*')
+re_empty = re.compile(r'^$')
+
+
+def remove_special_chars_legacy(s) -> str:
+    remove = '&<>.,:;_^-+=/\\*!"()}{?$#@|%'
+    replace_with_space = '&<>.,:;_^-+=/\\*!"()}{?$#@|%'
+    for c in remove:
+        s = s.replace(c, '')
+    for c in replace_with_space:
+        s = s.replace(c, ' ')
+    return s
+
+
+def parse_email_legacy(filename) -> dict:
+    email = {}
+    email['words'] = {}
+    email['ip'] = None
+    email['hour'] = None
+    f = codecs.open(filename, 'r', 'utf8', errors='ignore')
+
+    reached_content = False
+    for line in f:
+        line = line.strip().lower()
+        if re_received.match(line):
+            ip_re = dataloader.re_ip.findall(line)
+            email['ip'] = ip_re[0] if len(ip_re) > 0 else None
+        if re_date.match(line):
+            if not reached_content:
+                date_re = dataloader.re_hour.findall(line)
+                if len(date_re) > 0:
+                    hour = date_re[0].strip(":")
+                    email['hour'] = hour
+        elif re_empty.match(line):
+            reached_content = True
+        elif not reached_content:
+            continue
+        else:
+            line = re.sub(dataloader.re_url, TOKEN_URL, line)
+            line = re.sub(dataloader.re_email, TOKEN_EMAIL, line)
+            line = re.sub(dataloader.re_only_special_char, TOKEN_SYMBOLS, line)
+            line = remove_special_chars_legacy(line)
+            for word in line.split():
+                incr(email['words'], word)
+    f.close()
+    return email
+
+
+def load_paths(index_file) -> list:
+    root = os.path.dirname(index_file)
+    paths = []
+    with open(index_file) as f:
+        for line in f:
+            line = line.split()
+            if len(line) >= 2:
+                # '../data/000/000', as in DataLoader.load_paths
+                dir_0, dir_1 = line[1].split('/')[2:4]
+                paths.append(os.path.join(root, 'data', dir_0, dir_1))
+    return paths
+
+
+def check(paths: list) -> int:
+    '''
+    Return # emails parsed differently, print the first few
+    '''
+    num_bytes = sum(os.path.getsize(path) for path in paths)
+    legacy, legacy_secs = timed(lambda: [parse_email_legacy(path) for path in paths])
+    new, new_secs = timed(lambda: [dataloader.parse_email(path) for path in paths])
+    num_diff = 0
+    for path, a, b in zip(paths, legacy, new):
+        # Same words in the same order (of first occurrence)
+        if list(a['words'].items()) != list(b['words'].items()) \
+                or a['ip'] != b['ip'] or a['hour'] != b['hour']:
+            num_diff += 1
+            if num_diff <= 5:
+                print(_file, 'Mismatch:', path)
+    mb = num_bytes / 2**20
+    print(_file, f'{len(paths)} emails, {mb:.1f} MB, {num_diff} mismatches')
+    print(_file, f'legacy:      {mb / legacy_secs:8.2f} MB/s')
+    print(_file, f'parse_email: {mb / new_secs:8.2f} MB/s  x{legacy_secs / new_secs:.2f}')
+    return num_diff
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--index',
+        help='index file of the corpus',
+        default=os.path.join('..', 'data', 'trec06p', 'index'))
+    parser.add_argument(
+        '--synth',
+        help='check a synthetic corpus of this many emails instead',
+        type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.synth:
+        with tempfile.TemporaryDirectory() as root:
+            paths = [path for path, _ in gen_corpus(root, args.synth)]
+            num_diff = check(paths)
+    else:
+        num_diff = check(load_paths(args.index))
+    sys.exit(1 if num_diff else 0)
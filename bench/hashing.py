@@ -0,0 +1,93 @@
+'''
+Accuracy and memory of hashed word counts (CorpusStats(hash_buckets=N))
+against exact per-word counts, on synthetic corpora. A large --rare_vocab
+simulates spammers inflating the vocab with random tokens.
+
+    cd bench && python3 hashing.py --size 20000 --buckets 4096 65536 1048576
+'''
+import os
+import sys
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from synth import gen_corpus
+from bench import timed
+from dataloader import parse_email
+from preprocess import CorpusStats
+from test import calc_score
+
+
+_file = f'[{os.path.basename(__file__)}]'
+
+
+def measure(train: list, dev: list, hash_buckets=None) -> dict:
+    tracemalloc.start()
+    stats, count_secs = timed(CorpusStats(hash_buckets).update, train)
+    stats_mb = tracemalloc.get_traced_memory()[0] / 2**20
+    tracemalloc.stop()
+
+    classifier = stats.build_classifier(use_ip=True, use_time=True, time_weight=2)
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, 'model.nbm')
+        classifier.save(filename)
+        model_mb = os.path.getsize(filename) / 2**20
+    predict, score_secs = timed(classifier.classify_batch, dev)
+    scores = calc_score([e['label'] for e in dev], predict)
+    return {
+        'buckets': hash_buckets or '-',
+        'stats_mb': stats_mb,
+        'model_mb': model_mb,
+        'count_secs': count_secs,
+        'score_secs': score_secs,
+        **scores,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--size',
+        help='number of emails of the synthetic corpus',
+        type=int,
+        default=10000)
+    parser.add_argument(
+        '--rare_vocab',
+        help='number of distinct rare tokens of the synthetic corpus',
+        type=int,
+        default=10**7)
+    parser.add_argument(
+        '--buckets',
+        help='numbers of hash buckets to compare',
+        type=int,
+        nargs='+',
+        default=[2**12, 2**16, 2**20])
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as root:
+        examples = gen_corpus(root, args.size, args.seed, rare_vocab=args.rare_vocab)
+        emails = []
+        for path, label in examples:
+            email = parse_email(path)
+            email['label'] = label
+            emails.append(email)
+    split = len(emails) * 4 // 5
+    train, dev = emails[:split], emails[split:]
+
+    results = [measure(train, dev)] + [measure(train, dev, n) for n in args.buckets]
+    # Progress of the classifiers is printed above the table
+    print(f'{"buckets":>9} {"stats MB":>9} {"model MB":>9} {"count s":>8} {"score s":>8} '
+          f'{"accuracy":>9} {"macro_f1":>9} {"recall":>9}')
+    for r in results:
+        print(f'{r["buckets"]:>9} {r["stats_mb"]:9.2f} {r["model_mb"]:9.2f} '
+              f'{r["count_secs"]:8.2f} {r["score_secs"]:8.3f} {r["acc"]*100:9.3f} '
+              f'{r["macro_f1"]*100:9.3f} {r["recall"]*100:9.3f}')
@@ -0,0 +1,134 @@
+'''
+Lookups/sec and memory of the prefix IP index (IPIndex) against flat
+per-label dicts of /32 log-probabilities, on random IPs drawn from a few
+subnets so that unseen IPs share prefixes with training IPs.
+
+    cd bench && python3 ip_prefix.py --ips 100000 1000000
+'''
+import os
+import sys
+import math
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from bench import timed
+from ip_index import IPIndex
+
+
+_file = f'[{os.path.basename(__file__)}]'
+
+LABELS = [0, 1]
+SMOOTH_FACTOR = 1e-16
+
+
+def gen_ips(rng: random.Random, n: int, subnets: list) -> list:
+    return [f'{rng.choice(subnets)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}'
+            for _ in range(n)]
+
+
+def gen_counts(rng: random.Random, n: int, subnets: dict) -> dict:
+    '''
+    Return label_ip_cnts of `n` emails, IPs of label l from subnets[l]
+    '''
+    label_ip_cnts = {label: {} for label in LABELS}
+    for _ in range(n):
+        label = rng.choice(LABELS)
+        ip = gen_ips(rng, 1, subnets[label])[0]
+        cnts = label_ip_cnts[label]
+        cnts[ip] = cnts.get(ip, 0) + 1
+    return label_ip_cnts
+
+
+def build_dicts(label_ip_cnts: dict) -> tuple:
+    '''
+    Flat tables as classifier.build_logp_table: ({label: {ip: log P}},
+    {label: log P of unseen ip})
+    '''
+    total = sum(len(cnts) for cnts in label_ip_cnts.values())
+    tables, unseen = {}, {}
+    for label, cnts in label_ip_cnts.items():
+        log_denom = math.log(sum(cnts.values()) + total * SMOOTH_FACTOR)
+        tables[label] = {ip: math.log(cnt + SMOOTH_FACTOR) - log_denom for ip, cnt in cnts.items()}
+        unseen[label] = math.log(SMOOTH_FACTOR) - log_denom
+    return tables, unseen
+
+
+def measure(build, *args) -> tuple:
+    '''
+    Return (result of build, seconds, MB allocated), memory is measured
+    on a second build as tracing slows it down
+    '''
+    result, secs = timed(build, *args)
+    tracemalloc.start()
+    copy = build(*args)
+    mb = tracemalloc.get_traced_memory()[0] / 2**20
+    tracemalloc.stop()
+    del copy
+    return result, secs, mb
+
+
+def lookup_dicts(tables: dict, unseen: dict, ips: list) -> list:
+    return [[tables[label].get(ip, unseen[label]) for label in LABELS] for ip in ips]
+
+
+def lookup_index_each(index: IPIndex, ips: list) -> list:
+    return [index.logp([ip], SMOOTH_FACTOR)[0] for ip in ips]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--ips',
+        help='numbers of training emails (IPs) to compare',
+        type=int,
+        nargs='+',
+        default=[10**4, 10**5, 10**6])
+    parser.add_argument(
+        '--queries',
+        help='number of IPs looked up',
+        type=int,
+        default=10**5)
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = random.Random(args.seed)
+    # /16s of each label, a few shared
+    pool = [f'{rng.randint(1, 223)}.{rng.randint(0, 255)}' for _ in range(400)]
+    subnets = {0: pool[:250], 1: pool[150:]}
+
+    rows = []
+    for n in args.ips:
+        label_ip_cnts = gen_counts(rng, n, subnets)
+        # Half IPs seen in training, half new
+        seen = [ip for cnts in label_ip_cnts.values() for ip in cnts]
+        queries = [rng.choice(seen) for _ in range(args.queries // 2)]
+        queries += gen_ips(rng, args.queries - len(queries), pool)
+        rng.shuffle(queries)
+        num_seen = sum(any(ip in cnts for cnts in label_ip_cnts.values()) for ip in queries)
+
+        (tables, unseen), dict_build, dict_mb = measure(build_dicts, label_ip_cnts)
+        _, dict_secs = timed(lookup_dicts, tables, unseen, queries)
+        index, index_build, index_mb = measure(IPIndex, label_ip_cnts, LABELS)
+        _, batch_secs = timed(index.logp, queries, SMOOTH_FACTOR)
+        # Single lookups as in classify, on a sample
+        sample = queries[:args.queries // 10]
+        _, each_secs = timed(lookup_index_each, index, sample)
+        rows.append((n, num_seen / len(queries), dict_mb, index_mb,
+                     dict_build, index_build, len(queries) / dict_secs,
+                     len(queries) / batch_secs, len(sample) / each_secs))
+        print(_file, f'{n} IPs done')
+
+    print(f'{"# IPs":>8} {"seen":>5} {"dict MB":>8} {"index MB":>9} '
+          f'{"dict s":>7} {"index s":>8} {"dict/s":>10} {"batch/s":>10} {"single/s":>10}')
+    for row in rows:
+        print('{:8d} {:5.2f} {:8.2f} {:9.2f} {:7.2f} {:8.2f} {:10.0f} {:10.0f} {:10.0f}'
+              .format(*row))
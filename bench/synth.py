@@ -0,0 +1,78 @@
+import os
+import random
+
+
+HAM_WORDS = [
+    'meeting', 'project', 'report', 'schedule', 'review', 'thanks', 'team',
+    'attached', 'draft', 'budget', 'lunch', 'family', 'weekend', 'python',
+    'code', 'release', 'question', 'minutes', 'agenda', 'update']
+SPAM_WORDS = [
+    'free', 'money', 'winner', 'click', 'offer', 'cheap', 'prize', 'casino',
+    'loan', 'viagra', 'discount', 'limited', 'guaranteed', 'credit', 'cash',
+    'bonus', 'urgent', 'unsubscribe', 'pills', 'deal']
+COMMON_WORDS = [
+    'the', 'a', 'and', 'to', 'of', 'in', 'is', 'you', 'for', 'it', 'this',
+    'that', 'with', 'on', 'be', 'are', 'your', 'we', 'have', 'will']
+
+HAM_SUBNETS = [f'10.{i}' for i in range(16)] + ['192.168']
+SPAM_SUBNETS = [f'{a}.{b}' for a in (58, 61, 83, 201) for b in range(0, 256, 32)] + ['192.168']
+
+
+def gen_email(rng: random.Random, spam: bool, num_lines: int, rare_vocab: int) -> str:
+    '''
+    Return text of a synthetic email in the trec06p layout: headers, an
+    empty line, then the body.
+    '''
+    words = SPAM_WORDS if spam else HAM_WORDS
+    # A few /16 subnets per label, so that IPs share prefixes
+    subnet = rng.choice(SPAM_SUBNETS if spam else HAM_SUBNETS)
+    ip = f'{subnet}.{rng.randint(0, 255)}.{rng.randint(1, 254)}'
+    hour = rng.randint(0, 23)
+    lines = [
+        # parse_email keeps the IP of the last Received line, the first hop
+        'Received: from localhost (localhost)',
+        f'Received: from mail{rng.randint(0, 999)}.example.com ([{ip}]) by mx.example.org',
+        f'Date: Mon, {rng.randint(1, 28)} Jan 2007 {hour:02d}:{rng.randint(0, 59):02d}:00 +0000',
+        f'Subject: {" ".join(rng.choices(words, k=3))}',
+        '',
+    ]
+    for _ in range(num_lines):
+        r = rng.random()
+        if r < 0.03:
+            lines.append(f'http://www.{rng.choice(words)}.com/{rng.randint(0, 9999)}')
+        elif r < 0.05:
+            lines.append(f'contact {rng.choice(words)}@example.com now')
+        elif r < 0.07:
+            lines.append('-' * rng.randint(3, 40))
+        elif r < 0.1:
+            lines.append('')
+        else:
+            tokens = rng.choices(words + COMMON_WORDS, k=rng.randint(3, 14))
+            # Long tail of rare tokens, so the vocab grows with the corpus
+            tokens.append(f'tok{int(rare_vocab ** rng.random())}')
+            lines.append(' '.join(tokens) + rng.choice(['', '.', '!', ',', ' $100']))
+    return '\n'.join(lines) + '\n'
+
+
+def gen_corpus(root, num_emails: int, seed=0, spam_ratio=0.6, avg_lines=30, rare_vocab=100000):
+    '''
+    Write `num_emails` synthetic emails under `root`/data/<dir_0>/<dir_1>
+    and an index file `root`/index in the trec06p format.
+    Return list of (path, label), 1 = spam, 0 = ham
+    '''
+    rng = random.Random(seed)
+    examples = []
+    index_lines = []
+    for i in range(num_emails):
+        dir_0, dir_1 = f'{i // 300:03d}', f'{i % 300:03d}'
+        os.makedirs(os.path.join(root, 'data', dir_0), exist_ok=True)
+        path = os.path.join(root, 'data', dir_0, dir_1)
+        spam = rng.random() < spam_ratio
+        num_lines = max(1, int(rng.expovariate(1 / avg_lines)))
+        with open(path, 'w', encoding='utf8') as f:
+            f.write(gen_email(rng, spam, num_lines, rare_vocab))
+        examples.append((path, int(spam)))
+        index_lines.append(f'{"spam" if spam else "ham"} ../data/{dir_0}/{dir_1}\n')
+    with open(os.path.join(root, 'index'), 'w') as f:
+        f.writelines(index_lines)
+    return examples
@@ -8,8 +8,6 @@ sizes=(
 )
 
 cd src
-for size in ${sizes[@]}
-do
-    python3 preprocess.py --data_size ${size}
-    python3 test.py > ../result/size_${size}.txt
-done
\ No newline at end of file
+python3 learning_curve.py \
+    --sizes ${sizes[@]} \
+    --workers $(nproc) > ../result/data_size.txt
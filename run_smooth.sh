@@ -10,7 +10,6 @@ smooth=(
     10
     100
 )
-for s in ${smooth[@]}
-do
-    python3 test.py --smooth $s > ../result/smooth_${s}.txt
-done
\ No newline at end of file
+python3 test.py \
+    --sweep smooth=$(IFS=,; echo "${smooth[*]}") \
+    --workers $(nproc) > ../result/smooth.txt
@@ -1,17 +1,40 @@
 import os
 import math
+import json
+import struct
+from itertools import chain
+import numpy as np
+from scipy import sparse
 from utils import *
+from vocab import Vocabulary, HashedVocabulary, MappedVocabulary
+from corpus import Corpus, column, distinct
+from ip_index import IPIndex, IP_BACKOFF
+import profiling
 from tqdm import tqdm
 
 
 _file = f'[{os.path.basename(__file__)}]'
 
+# Binary model format, see NaiveBayesClassifier.save
+MODEL_MAGIC = b'NBMODEL\0'
+MODEL_VERSION = 2
+MODEL_ALIGN = 64
+
+# Margin of log-odds under which classify_early_exit scores in full, so
+# that rounding of the partial sums never changes the label
+EARLY_EXIT_TOL = 1e-9
+
 
 class NaiveBayesClassifier:
     '''
     label_cnts: {label: # examples with this label, }
     global_word_cnts: {word: its total occurence in training data, }
 
+    Words are mapped to ids by self.vocab, word counts and IDF are kept in
+    arrays indexed by word id. If `vocab` is given, global_word_cnts,
+    label_word_cnts and idf are expected to be such arrays already.
+    With a HashedVocabulary ids are hash buckets (see
+    CorpusStats.build_classifier), the arrays never grow.
     '''
     def __init__(self, 
         label_cnts: dict, 
@@ -25,22 +48,34 @@ class NaiveBayesClassifier:
         use_time=False,
         use_ip=False,
         time_weight=1.0,
-        ip_weight=1.0):
+        ip_weight=1.0,
+        ip_backoff=IP_BACKOFF,
+        vocab=None):
 
         # Params
         assert type(label_cnts) is dict
         self.label_cnts = label_cnts
-        self.global_word_cnts = dict(global_word_cnts)
-        self.label_word_cnts = dict(label_word_cnts)  # {label: {word: cnt, }, }
         self.label_ip_cnts = dict(label_ip_cnts)
         self.label_time_cnts = dict(label_time_cnts)
-        self.labels = label_cnts.keys()
+        self.labels = list(label_cnts.keys())
+        self.label_index = {label: i for i, label in enumerate(self.labels)}
         for label in self.labels:
-            self.label_word_cnts[label] = dict(self.label_word_cnts[label])
             self.label_time_cnts[label] = dict(self.label_time_cnts[label])
             self.label_ip_cnts[label] = dict(self.label_ip_cnts[label])
-            
-        self.idf = idf
+
+        if vocab is None:
+            # Word counts (dict or list of (word, cnt)) -> arrays
+            global_word_cnts = items_of(global_word_cnts)
+            vocab = Vocabulary(word for word, _ in global_word_cnts)
+            self.vocab = vocab
+            global_word_cnts = self.count_array(global_word_cnts)
+            label_word_cnts = np.stack(
+                [self.count_array(items_of(label_word_cnts[label])) for label in self.labels])
+            idf = np.append(self.count_array(items_of(idf), np.float64), 0.0)
+        self.vocab = vocab
+        self.global_word_cnts = global_word_cnts  # (vocab_size,)
+        self.label_word_cnts = label_word_cnts    # (# labels, vocab_size)
+        self.idf = idf                            # (vocab_size + 1,), IDF of unseen words (0) at the end
 
         self.num_features = num_features
         self.smooth_factor = smooth_factor
@@ -48,13 +83,15 @@ class NaiveBayesClassifier:
         self.use_ip = use_ip
         self.time_weight = time_weight
         self.ip_weight = ip_weight
+        self.ip_backoff = ip_backoff  # weights of the /32, /24, /16 IP estimates
 
         # self.use_ip = False
         # self.use_time = False
         
         # Reused values
         self.pre_computed = False
-        self.vocab_size = len(global_word_cnts)
+        self.vocab_size = len(self.vocab)
+        self.num_seen_words = None  # words with a count > 0, for smoothing
         self.num_examples = sum(label_cnts.values())
         self.num_words_in_label = {}
         self.num_time_in_label = {}
@@ -65,6 +102,45 @@ class NaiveBayesClassifier:
         # 贝叶斯公式中的先验知识
         self.logp_label = {}       # log(P(y))
 
+        # Smoothed log-probability tables, rebuilt by set_smooth_factor
+        # log P(w|C) = log_word_num[w, C] - log_word_denom[C]
+        self.log_word_num = None   # (vocab_size + 1, # labels), last row for unseen words
+        self.log_word_denom = None # (# labels,)
+        self.logp_smooth_factor = None  # smoothing factor of log_word_num
+        self.logp_time = {}        # {label: {hour: log P(hour|C)}}
+        self.logp_time_unseen = {}
+        self.ip_index = None       # IPIndex of label_ip_cnts, built on first use
+
+        # idf needs to be recomputed from counts (see build_idf), ranking
+        # words for extract_features only needs the counts (see idf_keys)
+        self.idf_stale = False
+        # {name: buffer} of the word arrays, which are views of them, and
+        # the number of words the buffers have room for, see grow_arrays
+        self.word_buffers = None
+        self.capacity = 0
+
+        # (corpus vocab, vocab_size, ids of its words), see corpus_ids
+        self.corpus_id_map = None
+
+        # Incremented each time the log-probability tables change, so that
+        # cached scores (see ResultCache) can be invalidated
+        self.version = 0
+        # (version, IPIndex, *early_exit_tables()), see early_exit_tables
+        self.early_exit_cache = None
+
+    def count_array(self, cnts, dtype=np.int64) -> np.ndarray:
+        '''
+        Return array of the counts in `cnts` (list of (word, cnt)) indexed
+        by word id, words not in vocab are dropped.
+        '''
+        arr = np.zeros(len(self.vocab), dtype=dtype)
+        for word, cnt in cnts:
+            i = self.vocab.get(word)
+            if i >= 0:
+                arr[i] = cnt
+        return arr
+
+    @profiling.timed('classifier.pre_compute')
     def pre_compute(self) -> None:
         """
         计算先验知识，如 log(P(y))，每个 label 下的词数，等
@@ -73,43 +149,353 @@ class NaiveBayesClassifier:
 
         self.total_num_time = 0
         self.total_num_ip = 0
+        num_words = self.label_word_cnts.sum(axis=1)
+        self.num_seen_words = int(np.count_nonzero(self.global_word_cnts))
         for label in self.labels:
             # self.logp_label_word[label] = {}
 
-            label_cnt = self.label_cnts[label]
-            self.logp_label[label] = math.log(label_cnt / self.num_examples)
-
-            self.num_words_in_label[label] = sum(cnt for cnt in self.label_word_cnts[label].values())
+            self.num_words_in_label[label] = int(num_words[self.label_index[label]])
             self.num_time_in_label[label] = sum(cnt for cnt in self.label_time_cnts[label].values())
             self.num_ip_in_label[label] = sum(cnt for cnt in self.label_ip_cnts[label].values())
             self.total_num_ip += self.num_ip_in_label[label]
             self.total_num_time += self.num_time_in_label[label]
         
+        self.build_logp_tables()
+
         print(_file, "total number of ip:", self.total_num_ip)
         print(_file, 'total number of time:', self.total_num_time)
         print(_file, "# words in each class:", self.num_words_in_label)
         print(_file, 'P(y):', self.logp_label)
         self.pre_computed = True
 
-    def get_idf(self, t) -> float:
-        return get_or(t, self.idf, 0.0)
+    def build_logp_table(self, cnts: dict, denom: float) -> tuple:
+        '''
+        Return ({key: log((cnt + smooth) / denom)}, log(smooth / denom))
+        '''
+        table = {}
+        for key, cnt in cnts.items():
+            table[key] = math.log((cnt + self.smooth_factor) / denom)
+        unseen = math.log(self.smooth_factor / denom)
+        return table, unseen
+
+    @profiling.timed('classifier.build_idf')
+    def build_idf(self) -> None:
+        '''
+        Recompute IDF from the counts if they were updated. Only needed to
+        save the model or get IDF values, features are ranked by idf_keys.
+        '''
+        if self.idf_stale:
+            # Each email counts a word once, so word counts are the
+            # document frequencies. Words no longer in any email get 0.
+            df = self.global_word_cnts
+            ratio = np.ones(self.vocab_size)
+            np.divide(self.num_examples, df, out=ratio, where=df > 0)
+            self.idf = np.append(np.log(ratio), 0.0)
+            self.idf_stale = False
+
+    def idf_keys(self, ids: np.ndarray) -> np.ndarray:
+        '''
+        Return keys that order word `ids` by descending IDF, equal for
+        equal IDF. IDF = log(N / df) only depends on the order of the
+        document frequencies df (word counts), so the key of a word is its
+        df, and N for words with df = 0 and unseen words (id vocab_size),
+        whose IDF is 0 as for words in every email. Updating counts thus
+        changes the keys of the updated words only.
+        '''
+        df = np.zeros(len(ids), dtype=np.int64)
+        seen = ids < self.vocab_size
+        df[seen] = self.global_word_cnts[ids[seen]]
+        return np.where(df > 0, df, self.num_examples)
+
+    @profiling.timed('classifier.build_logp_tables')
+    def build_logp_tables(self) -> None:
+        '''
+        Materialize log P(w|C), log P(ip|C) and log P(hour|C), these only
+        depend on the counts and the smoothing factor.
+        '''
+        # A loaded model may come with the numerators for this smoothing factor
+        if self.logp_smooth_factor != self.smooth_factor:
+            self.log_word_num = np.empty((self.vocab_size + 1, len(self.labels)))
+            self.log_word_num[:-1] = np.log(self.label_word_cnts.T + self.smooth_factor)
+            self.log_word_num[-1] = math.log(self.smooth_factor)
+            self.logp_smooth_factor = self.smooth_factor
+        self.build_logp_denoms()
+
+    def build_logp_denoms(self) -> None:
+        '''
+        Recompute everything that depends on the totals of the counts:
+        log P(y), the denominators of log P(w|C), and the hour table.
+        '''
+        self.version += 1
+        self.log_word_denom = np.empty(len(self.labels))
+        for j, label in enumerate(self.labels):
+            self.logp_label[label] = math.log(self.label_cnts[label] / self.num_examples)
+            # Words whose counts all went back to 0 (forget) are left out,
+            # as words never seen
+            denom = self.num_words_in_label[label] + self.num_seen_words * self.smooth_factor
+            self.log_word_denom[j] = math.log(denom)
+
+            # Hours never seen with the label get the unseen default
+            denom = self.label_cnts[label] + self.total_num_time * self.smooth_factor
+            self.logp_time[label], self.logp_time_unseen[label] = self.build_logp_table(
+                self.label_time_cnts[label], denom)
+
+    def set_smooth_factor(self, smooth_factor: float) -> None:
+        '''
+        Change the smoothing factor, only the log-probability tables are
+        rebuilt.
+        '''
+        self.smooth_factor = smooth_factor
+        if self.pre_computed:
+            self.build_logp_tables()
+
+    def partial_fit(self, emails: list) -> None:
+        '''
+        Add the counts of `emails` (parsed emails with 'label') to the
+        model, e.g. to fold in spam reports without retraining.
+        '''
+        self.update_counts(emails, 1)
+
+    def forget(self, emails: list) -> None:
+        '''
+        Remove the counts of `emails`, which must have been trained on.
+        Their words stay in the vocab, with count 0 if no email is left,
+        and score as unseen words, so that forget undoes partial_fit.
+        Raises ValueError if no email of a label would be left.
+        '''
+        num_forgotten = {}
+        for email in emails:
+            incr(num_forgotten, email['label'])
+        for label, cnt in num_forgotten.items():
+            if cnt >= self.label_cnts[label]:
+                raise ValueError(f'Cannot forget all the {self.label_cnts[label]} emails '
+                                 f'of label {label}')
+        self.update_counts(emails, -1)
+
+    @profiling.timed('classifier.update_counts')
+    def update_counts(self, emails: list, sign: int) -> None:
+        '''
+        Add (sign = 1) or subtract (sign = -1) the counts of `emails`. Only
+        the log P(w|C) numerators of the words in `emails` are recomputed,
+        plus what depends on totals (O(# labels)). IDF depends on the
+        number of examples, it is recomputed lazily on next use.
+        '''
+        if not self.pre_computed:
+            self.pre_compute()
+        self.make_writeable()
+
+        label_ids = {label: [] for label in self.labels}
+        for email in emails:
+            label = email['label']
+            if sign > 0:
+                ids = [self.vocab.add(word) for word in email['words']]
+            else:
+                ids = [self.vocab[word] for word in email['words']]
+            # Once per email, words may share a bucket of a HashedVocabulary
+            label_ids[label] += set(ids)
+            self.label_cnts[label] += sign
+            self.num_examples += sign
+            if email['ip'] is not None:
+                update_cnt(self.label_ip_cnts[label], email['ip'], sign)
+                self.num_ip_in_label[label] += sign
+                self.total_num_ip += sign
+                if self.ip_index is not None:
+                    self.ip_index.add(email['ip'], label, sign)
+            if email['hour'] is not None:
+                update_cnt(self.label_time_cnts[label], email['hour'], sign)
+                self.num_time_in_label[label] += sign
+                self.total_num_time += sign
+        if len(self.vocab) > self.vocab_size:
+            self.grow_arrays()
+
+        label_ids = {
+            label: np.unique(np.array(ids, dtype=np.int64), return_counts=True)
+            for label, ids in label_ids.items()}
+        touched = np.unique(np.concatenate(
+            [np.zeros(0, dtype=np.int64)] + [ids for ids, _ in label_ids.values()]))
+        num_seen = int(np.count_nonzero(self.global_word_cnts[touched]))
+        for j, label in enumerate(self.labels):
+            ids, cnts = label_ids[label]
+            self.label_word_cnts[j, ids] += sign * cnts
+            self.global_word_cnts[ids] += sign * cnts
+            self.num_words_in_label[label] += sign * int(cnts.sum())
+        self.num_seen_words += int(np.count_nonzero(self.global_word_cnts[touched])) - num_seen
+
+        self.log_word_num[touched] = np.log(
+            self.label_word_cnts[:, touched].T + self.smooth_factor)
+        self.build_logp_denoms()
+        self.idf_stale = True
+
+    def make_writeable(self) -> None:
+        '''
+        Copy arrays that are read-only (memory-mapped by load()) before
+        updating them, and make a Vocabulary of a MappedVocabulary to add
+        words to.
+        '''
+        if isinstance(self.vocab, MappedVocabulary):
+            self.vocab = self.vocab.to_vocabulary()
+        for name in ('global_word_cnts', 'label_word_cnts', 'log_word_num'):
+            arr = getattr(self, name)
+            if not arr.flags.writeable:
+                setattr(self, name, arr.copy())
+
+    def grow_arrays(self) -> None:
+        '''
+        Extend the word arrays to words newly added to self.vocab, rows
+        for unseen words stay at the end. The arrays are views of buffers
+        whose capacity doubles when full, so adding words costs in
+        proportion to the new words (amortized). IDF is rebuilt from the
+        counts when needed.
+        '''
+        old_size, size = self.vocab_size, len(self.vocab)
+        buffers = self.word_buffers
+        if buffers is None or size > self.capacity \
+                or any(getattr(self, name).base is not buf for name, buf in buffers.items()):
+            # Arrays of __init__, load() or set_smooth_factor: copy them
+            self.capacity = max(size, 2 * old_size)
+            num_labels = len(self.labels)
+            buffers = {
+                'global_word_cnts': np.zeros(self.capacity, dtype=self.global_word_cnts.dtype),
+                'label_word_cnts': np.zeros(
+                    (num_labels, self.capacity), dtype=self.label_word_cnts.dtype),
+                'log_word_num': np.empty((self.capacity + 1, num_labels)),
+            }
+            buffers['global_word_cnts'][:old_size] = self.global_word_cnts
+            buffers['label_word_cnts'][:, :old_size] = self.label_word_cnts
+            buffers['log_word_num'][:old_size + 1] = self.log_word_num
+            self.word_buffers = buffers
+        # New words have count 0, their rows are those of unseen words
+        unseen = buffers['log_word_num'][old_size].copy()
+        buffers['log_word_num'][old_size + 1 : size + 1] = unseen
+        buffers['global_word_cnts'][old_size:size] = 0
+        buffers['label_word_cnts'][:, old_size:size] = 0
+        self.global_word_cnts = buffers['global_word_cnts'][:size]
+        self.label_word_cnts = buffers['label_word_cnts'][:, :size]
+        self.log_word_num = buffers['log_word_num'][:size + 1]
+        self.vocab_size = size
+        self.idf_stale = True
+
+    @profiling.timed('classifier.save')
+    def save(self, filename) -> None:
+        '''
+        Save model in binary format: MODEL_MAGIC, version and length of a
+        JSON header (labels, IP and hour counts, layout of the rest), then
+        the vocab (arrays of a MappedVocabulary) and the word arrays, each
+        aligned to MODEL_ALIGN bytes so that load() can memory-map them.
+        '''
+        if not self.pre_computed:
+            self.pre_compute()
+        if self.idf_stale:
+            self.build_idf()
+        blobs = {
+            **self.vocab.to_arrays(),
+            'global_word_cnts': self.global_word_cnts,
+            'label_word_cnts': self.label_word_cnts,
+            'idf': self.idf,
+            'log_word_num': self.log_word_num,
+        }
+        layout = {}
+        offset = 0
+        for name, arr in blobs.items():
+            layout[name] = {'offset': offset, 'dtype': arr.dtype.str, 'shape': list(arr.shape)}
+            offset = align(offset + arr.nbytes, MODEL_ALIGN)
+        header = {
+            'labels': self.labels,
+            'label_cnts': [self.label_cnts[label] for label in self.labels],
+            'label_ip_cnts': [self.label_ip_cnts[label] for label in self.labels],
+            'label_time_cnts': [self.label_time_cnts[label] for label in self.labels],
+            'smooth_factor': self.logp_smooth_factor,
+            'hash_buckets': getattr(self.vocab, 'num_buckets', None),
+            'layout': layout,
+        }
+        header = json.dumps(header).encode('utf8')
+        prefix = MODEL_MAGIC + struct.pack('<II', MODEL_VERSION, len(header)) + header
+        start = align(len(prefix), MODEL_ALIGN)
+
+        with open(filename, 'wb') as f:
+            f.write(prefix)
+            for name, arr in blobs.items():
+                f.seek(start + layout[name]['offset'])
+                f.write(np.ascontiguousarray(arr).tobytes())
 
-    def extract_features(self, terms: list) -> float:
-        # for tf
-        term_cnts = list_to_occ_dict(terms)
-        total_terms = len(terms)
-        def get_tf(t) -> float:
-            return term_cnts[t] / total_terms
+    @classmethod
+    @profiling.timed('classifier.load')
+    def load(cls, filename, **kwargs):
+        '''
+        Load a model written by save(). The vocab and the word arrays are
+        memory-mapped read-only, so processes loading the same file share
+        its pages, and loading takes the same time whatever the vocab size.
+        `kwargs`: smooth_factor, use_ip, etc. as for __init__, smooth_factor
+        defaults to that of the saved log-probabilities
+        '''
+        data = np.memmap(filename, dtype=np.uint8, mode='r')
+        if bytes(data[:len(MODEL_MAGIC)]) != MODEL_MAGIC:
+            raise ValueError(f'{filename} is not a model file')
+        pos = len(MODEL_MAGIC)
+        version, header_len = struct.unpack('<II', bytes(data[pos : pos + 8]))
+        if version != MODEL_VERSION:
+            raise ValueError(f'{filename}: unsupported model version {version}')
+        pos += 8
+        header = json.loads(bytes(data[pos : pos + header_len]))
+        start = align(pos + header_len, MODEL_ALIGN)
 
-        def get_tfidf(t):
-            return get_tf(t) * self.get_idf(t)
+        arrays = {}
+        for name, info in header['layout'].items():
+            count = int(np.prod(info['shape']))
+            arr = np.frombuffer(
+                data, dtype=info['dtype'], count=count, offset=start + info['offset'])
+            arrays[name] = arr.reshape(info['shape'])
+
+        labels = header['labels']
+        if header['smooth_factor'] is not None:
+            kwargs.setdefault('smooth_factor', header['smooth_factor'])
+        if header.get('hash_buckets'):
+            vocab = HashedVocabulary(header['hash_buckets'])
+        elif 'vocab_table' in arrays:
+            vocab = MappedVocabulary(arrays['vocab'], arrays['vocab_offsets'], arrays['vocab_table'])
+        else:
+            # Saved without the hash table of the vocab
+            vocab = Vocabulary.from_bytes(arrays['vocab'])
+        model = cls(
+            dict(zip(labels, header['label_cnts'])),
+            arrays['global_word_cnts'],
+            arrays['label_word_cnts'],
+            dict(zip(labels, header['label_ip_cnts'])),
+            dict(zip(labels, header['label_time_cnts'])),
+            arrays['idf'],
+            vocab=vocab,
+            **kwargs)
+        model.log_word_num = arrays['log_word_num']
+        model.logp_smooth_factor = header['smooth_factor']
+        return model
+
+    def get_idf(self, t) -> float:
+        if self.idf_stale:
+            self.build_idf()
+        return float(self.idf[self.vocab.get(t, self.vocab_size)])
 
-        terms = [(t, get_tfidf(t)) for t in terms]
+    @profiling.timed('classifier.extract_features')
+    def extract_features(self, terms) -> list:
+        '''
+        Return the `num_features` terms with the highest TF-IDF, ties in
+        order of occurrence.
+        `terms`: count dict of the words of an email (email['words']). Each
+        term is considered once, so TF is the same for all of them and
+        the ranking only depends on IDF.
+        '''
+        terms = list(terms)
         # 仅保留最高 TF-IDF 的 n 个词
-        terms = sorted(terms, key=lambda x: x[1], reverse=True)
-        terms = [t[0] for t in terms]
-        return terms[:self.num_features]
+        # Unique key per term: IDF first, then position
+        ids = self.vocab.lookup(terms, self.vocab_size)
+        keys = self.idf_keys(ids) * len(terms) + np.arange(len(terms))
+        if len(terms) > self.num_features:
+            top = np.argpartition(keys, self.num_features - 1)[:self.num_features]
+            top = top[np.argsort(keys[top])]
+        else:
+            top = np.argsort(keys)
+        return [terms[i] for i in top]
 
+    @profiling.timed('classifier.classify')
     def classify(self, email) -> int:
         '''
         Return: label (int)
@@ -125,16 +511,17 @@ class NaiveBayesClassifier:
             prob_label[label] = self.logp_label[label]
         
         # for word in tqdm(words):
-        for word in words:
-            for label in self.labels:
-                pwc = self.calc_logp_word_label(word, label)
-                prob_label[label] += pwc
+        ids = self.vocab.lookup(words, self.vocab_size)
+        logp_words = self.log_word_num[ids].sum(axis=0) - len(ids) * self.log_word_denom
+        for j, label in enumerate(self.labels):
+            prob_label[label] += logp_words[j]
         
         if self.use_ip:
             ip = email['ip']
             if ip is not None:
-                for label in self.labels:
-                    prob_label[label] += self.ip_weight * self.calc_logp_ip_label(ip, label)
+                logp_ip = self.calc_logp_ip([ip])[0]
+                for j, label in enumerate(self.labels):
+                    prob_label[label] += self.ip_weight * logp_ip[j]
 
         if self.use_time:
             time = email['hour']
@@ -145,27 +532,212 @@ class NaiveBayesClassifier:
         predict = max(prob_label, key=lambda x: prob_label[x])
         return predict
 
+    def early_exit_tables(self) -> tuple:
+        '''
+        Return (log-odds of labels[1] against labels[0] of each word id,
+        max |log-odds| of a word, max |log-odds| of an IP), rebuilt when
+        the model changes
+        '''
+        ip_index = self.get_ip_index()
+        cached = self.early_exit_cache
+        if cached is None or cached[0] != self.version or cached[1] is not ip_index:
+            num = self.log_word_num
+            word_odds = (num[:, 1] - num[:, 0]) - (self.log_word_denom[1] - self.log_word_denom[0])
+            low, high = ip_index.logp_bounds(self.smooth_factor)
+            ip_bound = max(high[1] - low[0], high[0] - low[1])
+            self.early_exit_cache = (
+                self.version, ip_index, word_odds, float(np.abs(word_odds).max()), float(ip_bound))
+        return self.early_exit_cache[2:]
+
+    @profiling.timed('classifier.classify_early_exit')
+    def classify_early_exit(self, email) -> tuple:
+        '''
+        Same label as classify, but adds up the log-odds of the selected
+        words one at a time, in order of extract_features, and stops as
+        soon as what is left cannot flip the decision: each word left
+        changes the log-odds by at most the max |log-odds| of a word, the
+        IP by at most the max |log-odds| of an IP. The IP is only looked
+        up if the words do not decide.
+        Return: (label, # words evaluated)
+        '''
+        if not self.pre_computed:
+            self.pre_compute()
+        if len(self.labels) != 2:
+            return self.classify(email), min(len(email['words']), self.num_features)
+
+        word_odds, max_word_odds, ip_bound = self.early_exit_tables()
+        words = self.extract_features(email['words'])
+        ids = self.vocab.lookup(words, self.vocab_size)
+        # Log-odds of labels[1] against labels[0]
+        neg, pos = self.labels
+        odds = self.logp_label[pos] - self.logp_label[neg]
+        if self.use_time and email['hour'] is not None:
+            odds += self.time_weight * (
+                self.calc_logp_time_label(email['hour'], pos)
+                - self.calc_logp_time_label(email['hour'], neg))
+        use_ip = self.use_ip and email['ip'] is not None
+        ip_bound = abs(self.ip_weight) * ip_bound if use_ip else 0.0
+
+        num_words = len(ids)
+        for k, word_odd in enumerate(word_odds[ids].tolist(), 1):
+            odds += word_odd
+            if abs(odds) > (num_words - k) * max_word_odds + ip_bound + EARLY_EXIT_TOL:
+                return (pos if odds > 0 else neg), k
+        if use_ip:
+            logp_ip = self.calc_logp_ip([email['ip']])[0]
+            odds += self.ip_weight * (logp_ip[1] - logp_ip[0])
+        if abs(odds) > EARLY_EXIT_TOL:
+            return (pos if odds > 0 else neg), num_words
+        # Close call, score as classify does
+        return self.classify(email), num_words
+
+    @profiling.timed('classifier.select_features_batch')
+    def select_features_batch(self, emails: list):
+        '''
+        Vectorized extract_features over a batch of emails (list of email
+        dicts or Corpus).
+        Return: (n_emails, vocab_size + 1) sparse matrix, 1 for each selected
+        word, the last column counts selected words not seen in training.
+        '''
+        unk = self.vocab_size
+        if isinstance(emails, Corpus):
+            ids = self.corpus_ids(emails)[emails.tokens()]
+            lens = emails.lens()
+        else:
+            ids = self.vocab.lookup(
+                chain.from_iterable(email['words'] for email in emails), unk)
+            lens = np.fromiter((len(email['words']) for email in emails), dtype=np.int64)
+        # All the terms of emails with at most num_features terms are
+        # selected, only the terms of longer emails are ranked
+        long_rows = lens > self.num_features
+        if long_rows.any():
+            rows = np.repeat(np.arange(len(emails)), lens)
+            tokens = np.flatnonzero(long_rows[rows])
+            long_lens = lens[long_rows]
+            starts = np.repeat(np.cumsum(long_lens) - long_lens, long_lens)
+
+            # TF is the same for every term in an email, so terms are ranked
+            # by IDF only, ties are kept in order of occurrence (like sorted()).
+            idf_keys = self.idf_keys(ids[tokens])
+            keys = rows[tokens] * (int(idf_keys.max()) + 1) + idf_keys
+            order = tokens[np.argsort(keys, kind='stable')]
+            rank = np.arange(len(order)) - starts
+            selected = np.ones(len(ids), dtype=bool)
+            selected[order[rank >= self.num_features]] = False
+            ids = ids[selected]
+
+        # Terms of a row are not sorted by id, which the product allows
+        indptr = np.concatenate(([0], np.cumsum(np.minimum(lens, self.num_features))))
+        return sparse.csr_matrix(
+            (np.ones(len(ids)), ids, indptr),
+            shape=(len(emails), unk + 1))
+
+    def corpus_ids(self, corpus) -> np.ndarray:
+        '''
+        Return ids in self.vocab of the words of corpus.vocab, computed
+        once per corpus (and its slices) unless the vocab grows.
+        '''
+        cached = self.corpus_id_map
+        if cached is None or cached[0] is not corpus.vocab or cached[1] != self.vocab_size:
+            ids = self.vocab.lookup(corpus.vocab.words, self.vocab_size)
+            self.corpus_id_map = (corpus.vocab, self.vocab_size, ids)
+        return self.corpus_id_map[2]
+
+    @profiling.timed('classifier.score_components')
+    def score_components(self, x, emails: list) -> tuple:
+        '''
+        Return (word, ip, time) scores, arrays of shape (n_emails, # labels):
+        log P(y) + sum of log P(w|y) over the selected words, log P(ip|y)
+        and log P(hour|y), the latter two are 0 if the email has no ip/hour.
+        Scores do not depend on use_ip, use_time or the weights.
+        `x`: selected features of `emails`, from select_features_batch
+        '''
+        if not self.pre_computed:
+            self.pre_compute()
+        labels = self.labels
+
+        word_scores = x @ self.log_word_num
+        word_scores -= np.asarray(x.sum(axis=1)) * self.log_word_denom
+        word_scores += np.array([self.logp_label[label] for label in labels])
+        return (word_scores, *self.side_scores(emails))
+
+    def side_scores(self, emails: list) -> tuple:
+        '''
+        Return the (ip, time) scores of score_components, which do not
+        depend on the words
+        '''
+        labels = self.labels
+        # Emails of a batch share IPs and hours, each value is scored once
+        ips, ip_codes = distinct(column(emails, 'ip'))
+        ip_table = np.zeros((len(ips) + 1, len(labels)))  # last row for None
+        if ips:
+            ip_table[:-1] = self.calc_logp_ip(ips)
+
+        hours, hour_codes = distinct(column(emails, 'hour'))
+        time_table = np.zeros((len(hours) + 1, len(labels)))
+        for i, time in enumerate(hours):
+            time_table[i] = [self.calc_logp_time_label(time, label) for label in labels]
+        return ip_table[ip_codes], time_table[hour_codes]
+
+    def combine_scores(self, word_scores, ip_scores, time_scores) -> np.ndarray:
+        '''
+        Return scores of score_batch from those of score_components
+        '''
+        scores = word_scores
+        if self.use_ip:
+            scores = scores + self.ip_weight * ip_scores
+        if self.use_time:
+            scores = scores + self.time_weight * time_scores
+        return scores
+
+    @profiling.timed('classifier.score_batch')
+    def score_batch(self, emails: list) -> np.ndarray:
+        '''
+        Scores all emails with one sparse-dense matrix product.
+        Return: array of shape (n_emails, # labels), columns in order of
+        self.labels
+        '''
+        if not self.pre_computed:
+            self.pre_compute()
+
+        x = self.select_features_batch(emails)
+        return self.combine_scores(*self.score_components(x, emails))
+
+    def classify_batch(self, emails: list) -> list:
+        '''
+        Same as classify, but for a batch of emails, see score_batch
+        Return: list of labels
+        '''
+        scores = self.score_batch(emails)
+        return [self.labels[j] for j in scores.argmax(axis=1)]
+
+    @profiling.timed('classifier.calc_logp_word_label')
     def calc_logp_word_label(self, word, label) -> float:
         ''' Return log P(w|C) '''
         # P(w | C) = # w in C / # words in C
-        word_cnt = get_or(word, self.label_word_cnts[label], 0)
-        nom = word_cnt + self.smooth_factor
-        denom = self.num_words_in_label[label] + self.vocab_size * self.smooth_factor
-        return math.log(nom / denom)
+        i = self.vocab.get(word, self.vocab_size)
+        j = self.label_index[label]
+        return self.log_word_num[i, j] - self.log_word_denom[j]
+
+    def get_ip_index(self) -> IPIndex:
+        if self.ip_index is None:
+            self.ip_index = IPIndex(self.label_ip_cnts, self.labels, self.ip_backoff)
+        return self.ip_index
+
+    def calc_logp_ip(self, ips: list) -> np.ndarray:
+        '''
+        Return log P(ip|C) of each of `ips` (not None), backing off to the
+        /24 and /16 subnets, shape (# ips, # labels)
+        '''
+        return self.get_ip_index().logp(ips, self.smooth_factor)
 
     def calc_logp_ip_label(self, ip: str, label) -> float:
         assert ip is not None
-        ip_cnt = get_or(ip, self.label_ip_cnts, 0)
-        nom = ip_cnt + self.smooth_factor
-        denom = self.label_cnts[label] + self.total_num_ip * self.smooth_factor
-        return math.log(nom / denom)
+        return self.calc_logp_ip([ip])[0, self.label_index[label]]
 
     def calc_logp_time_label(self, time: str, label) -> float:
         assert time is not None
-        time_cnt = get_or(time, self.label_time_cnts, 0)
-        nom = time_cnt + self.smooth_factor
-        denom = self.label_cnts[label] + self.total_num_time * self.smooth_factor
-        return math.log(nom / denom)
+        return self.logp_time[label].get(time, self.logp_time_unseen[label])
         
 
 
@@ -0,0 +1,213 @@
+'''
+Classifies raw emails and writes one JSON line per email:
+    {"path": ..., "label": 1, "log_odds": 12.3}
+    {"path": ..., "error": "..."}          if the file could not be read
+Emails read from an index file also get their "gold" label.
+
+    python3 classify.py ../data/trec06p/data --workers 8 > result.jsonl
+    python3 classify.py ../data/trec06p/index
+    find /var/mail -type f | python3 classify.py -
+
+Worker processes parse batches of emails while this process scores the
+previous batches, at most a few batches per worker are in flight, so
+memory does not depend on the number of emails.
+
+With --cache_size, copies of recent emails are scored from a ResultCache
+(see result_cache.py), and with --cache_threshold so are near-duplicates,
+which then may not get the exact scores of full scoring.
+'''
+import os
+import sys
+import json
+import argparse
+import contextlib
+from collections import deque
+from multiprocessing import Pool
+from config import *
+from dataloader import parse_bytes
+from result_cache import ResultCache, content_key
+from test import add_model_args, load_classifier
+
+
+_file = '[' + os.path.basename(__file__) + ']'
+
+
+LABEL_TO_ID = {'ham': 0, 'spam': 1}
+
+
+def iter_dir(dirname):
+    '''
+    Yield (path, None) for every file under `dirname`, in sorted order
+    '''
+    for root, dirs, files in os.walk(dirname):
+        dirs.sort()
+        for name in sorted(files):
+            yield os.path.join(root, name), None
+
+
+def iter_index(filename):
+    '''
+    Yield (path, label) for every line of an index file like
+    data/trec06p/index ('spam ../data/000/000')
+    '''
+    root = os.path.dirname(filename)
+    with open(filename) as f:
+        for line in f:
+            line = line.split()
+            if len(line) < 2:
+                continue
+            dir_0, dir_1 = line[1].split('/')[2:4]
+            yield os.path.join(root, 'data', dir_0, dir_1), LABEL_TO_ID[line[0]]
+
+
+def iter_stdin():
+    for line in sys.stdin:
+        path = line.strip()
+        if path:
+            yield path, None
+
+
+def iter_source(source):
+    if source == '-':
+        return iter_stdin()
+    if os.path.isdir(source):
+        return iter_dir(source)
+    return iter_index(source)
+
+
+def iter_batches(items, batch_size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_batch(batch: list, with_keys=False) -> list:
+    '''
+    Return [(path, gold, email or None, content_key or None, error or None)],
+    content keys only `with_keys` (for the result cache)
+    '''
+    result = []
+    for path, gold in batch:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            result.append((path, gold, None, None, str(e)))
+            continue
+        key = content_key(data) if with_keys else None
+        result.append((path, gold, parse_bytes(data), key, None))
+    return result
+
+
+def iter_parsed(batches, workers: int, with_keys=False):
+    '''
+    Yield parsed batches in order, parsing up to 2 batches per worker
+    ahead of the consumer
+    '''
+    if workers <= 1:
+        for batch in batches:
+            yield parse_batch(batch, with_keys)
+        return
+    with Pool(workers) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.apply_async(parse_batch, (batch, with_keys)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def classify(args):
+    # Progress of the classifier goes to stderr, stdout is for results
+    with contextlib.redirect_stdout(sys.stderr):
+        classifier = load_classifier(args)
+        classifier.pre_compute()
+    spam = classifier.label_index[1]
+    ham = classifier.label_index[0]
+    cache = None
+    if args.cache_size > 0:
+        cache = ResultCache(classifier, args.cache_size, args.cache_threshold)
+
+    out = sys.stdout if args.out == '-' else open(args.out, 'w')
+    num_emails = 0
+    num_errors = 0
+    batches = iter_batches(iter_source(args.source), args.batch_size)
+    for parsed in iter_parsed(batches, args.workers, with_keys=cache is not None):
+        parsed_ok = [(email, key) for _, _, email, key, _ in parsed if email is not None]
+        emails = [email for email, _ in parsed_ok]
+        if not emails:
+            scores = iter(())
+        elif cache is not None:
+            scores = iter(cache.score_batch(emails, [key for _, key in parsed_ok]))
+        else:
+            scores = iter(classifier.score_batch(emails))
+        for path, gold, email, _, error in parsed:
+            if email is None:
+                record = {'path': path, 'error': error}
+                num_errors += 1
+            else:
+                row = next(scores)
+                record = {
+                    'path': path,
+                    'label': classifier.labels[int(row.argmax())],
+                    'log_odds': float(row[spam] - row[ham]),
+                }
+                if gold is not None:
+                    record['gold'] = gold
+            out.write(json.dumps(record) + '\n')
+        num_emails += len(parsed)
+    if out is not sys.stdout:
+        out.close()
+    print(_file, f'Classified {num_emails - num_errors} emails, {num_errors} errors', file=sys.stderr)
+    if cache is not None:
+        print(_file, 'Result cache:', cache.stats(), file=sys.stderr)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'source',
+        help='directory of emails, index file, or - to read paths from stdin',
+    )
+    parser.add_argument(
+        '--out',
+        help='JSONL file to write, - for stdout',
+        default='-',
+    )
+    parser.add_argument(
+        '--workers',
+        help='Number of processes parsing emails',
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        '--batch_size',
+        help='# emails parsed by a worker and scored at once',
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        '--cache_size',
+        help='Max # emails in the result cache, 0 = no cache',
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        '--cache_threshold',
+        help='Also score near-duplicates from the cache: min estimated Jaccard similarity'
+             ' of their words, e.g. 0.9',
+        type=float,
+    )
+    add_model_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    classify(args)
@@ -12,6 +12,8 @@ FILE_INDEX_DEV   = path.join(DIR_DATA, 'dev_index.txt')
 # Processed data
 FILE_TRAIN_DATASET      = path.join(DIR_PROCESSED, 'train_dataset.pkl')
 FILE_DEV_DATASET        = path.join(DIR_PROCESSED, 'dev_dataset.pkl')
+FILE_TRAIN_CORPUS       = path.join(DIR_PROCESSED, 'train_corpus')
+FILE_DEV_CORPUS         = path.join(DIR_PROCESSED, 'dev_corpus')
 FILE_GLOBAL_WORD_CNTS   = path.join(DIR_PROCESSED, 'words_all.pkl')
 FILE_WORDS_0            = path.join(DIR_PROCESSED, 'words_0.pkl')
 FILE_WORDS_1            = path.join(DIR_PROCESSED, 'words_1.pkl')
@@ -19,11 +21,21 @@ FILE_LABEL_CNTS         = path.join(DIR_PROCESSED, 'label_cnts.pkl')
 FILE_LABEL_IP_CNTS      = path.join(DIR_PROCESSED, 'label_ip_cnts.pkl')
 FILE_LABEL_TIME_CNTS    = path.join(DIR_PROCESSED, 'label_time_cnts.pkl')
 FILE_IDF                = path.join(DIR_PROCESSED, 'idf.pkl')
+FILE_MODEL              = path.join(DIR_PROCESSED, 'model.nbm')
+FILE_PARSE_CACHE        = path.join(DIR_PROCESSED, 'parse_cache.pkl')
+DIR_SHARD_COUNTS        = path.join(DIR_PROCESSED, 'shard_counts')
 
 
 TOKEN_URL       = '[URL]'
 TOKEN_EMAIL     = '[EMAIL]'
 TOKEN_SYMBOLS   = '[SYMBOLS]'
 TOKEN_NUM       = '[NUM]'
+SPECIAL_TOKENS  = {TOKEN_URL, TOKEN_EMAIL, TOKEN_SYMBOLS, TOKEN_NUM}
+
+SMOOTH_FACTOR = 1e-16
+
+# If set, e.g. 2 ** 20, words are counted in this many hash buckets instead
+# of per word, so memory does not grow with the number of distinct words
+HASH_BUCKETS = None
 
 SEED = 123
\ No newline at end of file
@@ -0,0 +1,180 @@
+import os
+import numpy as np
+from array import array
+from vocab import Vocabulary
+from utils import pickle_load
+
+
+# Arrays of a saved corpus, one .npy file each
+CORPUS_ARRAYS = ('indptr', 'token_ids', 'counts', 'labels', 'ips', 'hours')
+# Value tables of the token, IP and hour codes
+CORPUS_TABLES = ('vocab', 'ip_table', 'hour_table')
+
+
+class Corpus:
+    '''
+    Columnar store of parsed emails, instead of a list of email dicts:
+    words of email i are token_ids[indptr[i]:indptr[i + 1]] (ids in
+    self.vocab, in order of occurrence) with their counts, labels, IPs and
+    hours are arrays, IPs and hours coded as ids in their tables (-1 for
+    None).
+
+    Saved as a directory of .npy files which load() memory-maps, slicing
+    (corpus[a:b]) gives a view sharing the arrays. Indexing and iterating
+    give email dicts as parsed by parse_email.
+    '''
+    def __init__(self, indptr, token_ids, counts, labels, ips, hours, vocab, ip_table, hour_table):
+        self.indptr = indptr        # (n + 1,), not rebased in views
+        self.token_ids = token_ids  # (# tokens,)
+        self.counts = counts        # (# tokens,)
+        self.labels = labels        # (n,)
+        self.ips = ips              # (n,), id in ip_table or -1
+        self.hours = hours          # (n,), id in hour_table or -1
+        self.vocab = vocab
+        self.ip_table = ip_table
+        self.hour_table = hour_table
+
+    @classmethod
+    def from_emails(cls, emails):
+        '''
+        `emails`: any iterable of parsed emails, consumed once
+        '''
+        vocab = Vocabulary()
+        ip_table = Vocabulary()
+        hour_table = Vocabulary()
+        indptr = array('q', [0])
+        token_ids = array('i')
+        counts = array('i')
+        labels = array('b')
+        ips = array('i')
+        hours = array('i')
+        for email in emails:
+            words = email['words']
+            token_ids.extend(map(vocab.add, words))
+            counts.extend(words.values())
+            indptr.append(len(token_ids))
+            labels.append(email.get('label', -1))
+            ips.append(-1 if email['ip'] is None else ip_table.add(email['ip']))
+            hours.append(-1 if email['hour'] is None else hour_table.add(email['hour']))
+        return cls(
+            np.frombuffer(indptr, dtype=np.int64),
+            np.frombuffer(token_ids, dtype=np.int32),
+            np.frombuffer(counts, dtype=np.int32),
+            np.frombuffer(labels, dtype=np.int8),
+            np.frombuffer(ips, dtype=np.int32),
+            np.frombuffer(hours, dtype=np.int32),
+            vocab, ip_table, hour_table)
+
+    def save(self, dirname) -> None:
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # Views are saved rebased
+        start, end = self.indptr[0], self.indptr[-1]
+        arrays = {
+            'indptr': self.indptr - start,
+            'token_ids': self.token_ids[start:end],
+            'counts': self.counts[start:end],
+            'labels': self.labels,
+            'ips': self.ips,
+            'hours': self.hours,
+        }
+        for name in CORPUS_ARRAYS:
+            np.save(os.path.join(dirname, name + '.npy'), arrays[name])
+        for name in CORPUS_TABLES:
+            with open(os.path.join(dirname, name + '.txt'), 'wb') as f:
+                f.write(getattr(self, name).to_bytes())
+
+    @classmethod
+    def load(cls, dirname):
+        arrays = [np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+                  for name in CORPUS_ARRAYS]
+        tables = []
+        for name in CORPUS_TABLES:
+            with open(os.path.join(dirname, name + '.txt'), 'rb') as f:
+                tables.append(Vocabulary.from_bytes(f.read()))
+        return cls(*arrays, *tables)
+
+    def lens(self) -> np.ndarray:
+        '''
+        Return # distinct words of each email
+        '''
+        return np.diff(self.indptr)
+
+    def tokens(self) -> np.ndarray:
+        '''
+        Return token ids of all emails, concatenated
+        '''
+        return self.token_ids[self.indptr[0]:self.indptr[-1]]
+
+    def column(self, name) -> list:
+        '''
+        Return list of 'label', 'ip' or 'hour' of each email
+        '''
+        if name == 'label':
+            return self.labels.tolist()
+        codes, table = {'ip': (self.ips, self.ip_table), 'hour': (self.hours, self.hour_table)}[name]
+        values = table.words + [None]  # -1 -> None
+        return [values[i] for i in codes.tolist()]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError('Corpus slices must be contiguous')
+            return Corpus(
+                self.indptr[start : stop + 1], self.token_ids, self.counts,
+                self.labels[start:stop], self.ips[start:stop], self.hours[start:stop],
+                self.vocab, self.ip_table, self.hour_table)
+        if i < 0:
+            i += len(self)
+        start, end = self.indptr[i], self.indptr[i + 1]
+        words = self.vocab.words
+        email = {
+            'words': dict(zip([words[t] for t in self.token_ids[start:end]],
+                              self.counts[start:end].tolist())),
+            'ip': None if self.ips[i] < 0 else self.ip_table.words[self.ips[i]],
+            'hour': None if self.hours[i] < 0 else self.hour_table.words[self.hours[i]],
+        }
+        if self.labels[i] >= 0:
+            email['label'] = int(self.labels[i])
+        return email
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def column(dataset, name) -> list:
+    '''
+    Return list of `name` ('label', 'ip' or 'hour') of each email of a
+    Corpus or a list of email dicts
+    '''
+    if isinstance(dataset, Corpus):
+        return dataset.column(name)
+    return [email[name] for email in dataset]
+
+
+def distinct(values: list) -> tuple:
+    '''
+    Return (distinct values but None in order of first occurrence, array
+    of the index of each value in them, their number for None)
+    '''
+    index = dict.fromkeys(values)
+    index.pop(None, None)
+    uniq = list(index)
+    index = dict(zip(uniq, range(len(uniq))))
+    index[None] = len(uniq)
+    return uniq, np.fromiter(map(index.__getitem__, values), dtype=np.int64, count=len(values))
+
+
+def load_dataset(dirname, pickle_file):
+    '''
+    Load Corpus from `dirname`, or a list of email dicts from the pickle
+    file written by an older preprocess.py
+    '''
+    if os.path.exists(dirname):
+        return Corpus.load(dirname)
+    return pickle_load(pickle_file)
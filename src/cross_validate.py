@@ -0,0 +1,134 @@
+import os
+import random
+import argparse
+import numpy as np
+from multiprocessing import Pool
+from config import *
+from utils import *
+from dataloader import DataLoader
+from parse_cache import ParseCache
+from preprocess import CorpusStats, split_folds
+from test import add_model_args, calc_score, model_params
+
+
+_file = '[' + os.path.basename(__file__) + ']'
+
+
+random.seed(SEED)
+
+
+def load_folds(k_fold: int) -> dict:
+    '''
+    Return {(dir_0, dir_1): fold}, folds are split as in gen_index_file.
+    Emails in no fold have fold -1 (always in train set).
+    '''
+    with open(FILE_INDEX_FULL) as f:
+        lines = f.readlines()
+    random.shuffle(lines)
+    fold_of = {}
+    for line in lines:
+        fold_of[line_key(line)] = -1
+    for i, fold_lines in enumerate(split_folds(lines, k_fold)):
+        for line in fold_lines:
+            fold_of[line_key(line)] = i
+    return fold_of
+
+
+def line_key(line: str) -> tuple:
+    '''
+    'spam ../data/000/000' -> ('000', '000')
+    '''
+    path = line.strip().split()[1].split('/')
+    return path[2], path[3]
+
+
+# State of each process, set by init_fold
+fold_state = {}
+
+
+def init_fold(total, fold_stats, fold_emails, params):
+    fold_state['total'] = total
+    fold_state['fold_stats'] = fold_stats
+    fold_state['fold_emails'] = fold_emails
+    fold_state['params'] = params
+
+
+def eval_fold(fold: int) -> dict:
+    '''
+    Train on all emails but those of `fold` and test on `fold`. The counts
+    of the train set are the total counts minus those of `fold`, so no
+    email is parsed or counted again.
+    '''
+    stats = fold_state['total'].copy().subtract(fold_state['fold_stats'][fold])
+    classifier = stats.build_classifier(**fold_state['params'])
+    dataset = fold_state['fold_emails'][fold]
+    gold = [e['label'] for e in dataset]
+    predict = classifier.classify_batch(dataset)
+    return calc_score(gold, predict)
+
+
+def cross_validate(args):
+    '''
+    Parses the full corpus once, then evaluates all folds in parallel
+    '''
+    fold_of = load_folds(args.k_fold)
+    cache = None if args.no_cache else ParseCache(FILE_PARSE_CACHE)
+    loader = DataLoader(
+        FILE_INDEX_FULL, shuffle=False, workers=args.workers, stream=True, cache=cache)
+
+    total = CorpusStats(HASH_BUCKETS)
+    fold_stats = [CorpusStats(HASH_BUCKETS) for _ in range(args.k_fold)]
+    fold_emails = [[] for _ in range(args.k_fold)]
+    for path, email in zip(loader.paths, loader):
+        fold = fold_of[tuple(path.split(os.sep)[-2:])]
+        total.add(email)
+        if fold >= 0:
+            fold_stats[fold].add(email)
+            fold_emails[fold].append(email)
+
+    params = model_params(args)
+    state = (total, fold_stats, fold_emails, params)
+    print(_file, f'Evaluating {args.k_fold} folds...')
+    if args.workers > 1:
+        with Pool(min(args.workers, args.k_fold), init_fold, state) as pool:
+            results = pool.map(eval_fold, range(args.k_fold))
+    else:
+        init_fold(*state)
+        results = [eval_fold(fold) for fold in range(args.k_fold)]
+
+    metrics = ['acc', 'macro_f1', 'micro_f1', 'recall']
+    print(f'{"fold":>6} {"# dev":>7} ' + ' '.join(f'{m:>9}' for m in metrics))
+    for fold, scores in enumerate(results):
+        print(f'{fold:6d} {len(fold_emails[fold]):7d} '
+              + ' '.join(f'{scores[m]*100:9.3f}' for m in metrics))
+    for name, fn in [('mean', np.mean), ('std', np.std)]:
+        print(f'{name:>6} {"":7s} '
+              + ' '.join(f'{fn([s[m] for s in results])*100:9.3f}' for m in metrics))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--k_fold',
+        help='number of folds',
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        '--workers',
+        help='number of processes used to parse emails and evaluate folds',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--no_cache',
+        help='parse every email again instead of reading the parse cache',
+        action='store_true',
+    )
+    add_model_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    cross_validate(args)
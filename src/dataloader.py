@@ -1,96 +1,149 @@
 import os
 import random
 import re
-import codecs
+from collections import Counter
+from multiprocessing import Pool
 from tqdm import tqdm
 from config import *
 from utils import *
+import profiling
 
 
 _file = os.path.basename(__file__)
 
 
+# Compiled once, not on every call of parse_email
+re_url = re.compile(
+    r'^(?:http|ftp)s?://' # http:// or https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|' #domain...
+    r'localhost|' #localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})' # ...or ip
+    r'(?::\d+)?' # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+re_only_special_char = re.compile('^[\W_]+$')
+re_email = re.compile('[^@]+@[^@]+\.[^@]+')
+re_special_char = re.compile('\W')
+# Header prefixes, lines are stripped and lower-cased
+PREFIX_RECEIVED = 'received: from'
+PREFIX_DATE = 'date: '
+PREFIX_URL = ('http', 'ftp')
+re_ip = re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
+re_hour = re.compile(r'\d+:')
+
+# Special chars removed from content before splitting it into words
+SPECIAL_CHARS = '&<>.,:;_^-+=/\\*!"()}{?$#@|%'
+special_char_table = str.maketrans('', '', SPECIAL_CHARS)
+
+# Version of the emails returned by parse_bytes, to bump on any change of
+# them (tokens, patterns, fields) so that ParseCache files written by an
+# older parser are discarded
+PARSE_VERSION = 1
+
+
+def remove_special_chars(s) -> str:
+    return s.translate(special_char_table)
+
+
+@profiling.timed('dataloader.parse_email')
+def parse_email(filename) -> dict:
+    # File I/O apart from parsing (dataloader.parse_bytes)
+    with profiling.stage('dataloader.read_file'):
+        with open(filename, 'rb') as f:
+            data = f.read()
+    return parse_bytes(data)
+
+
+@profiling.timed('dataloader.parse_bytes')
+def parse_bytes(data: bytes) -> dict:
+    '''
+    Parse a raw (RFC822) email.
+    Return {'words': {word: # occurrences in content}, 'ip': IP of the last
+    Received header, 'hour': hour of the Date header}.
+
+    Headers end at the first empty line, everything afterwards is content.
+    The email is decoded at once, content lines are only matched against
+    the URL, email and symbols patterns when they can match, and are then
+    stripped of special chars and split in one go.
+    '''
+    text = data.decode('utf8', 'ignore').lower()
+    ip = None
+    hour = None
+    content = []
+
+    # When True, everything afterwards is content
+    reached_content = False
+    for line in text.splitlines():
+        line = line.strip()
+        # Parse ip (also on content lines)
+        if line.startswith(PREFIX_RECEIVED):
+            match = re_ip.search(line)
+            ip = match.group() if match else None
+        # Parse time, date lines are never content
+        if line.startswith(PREFIX_DATE):
+            if not reached_content:
+                match = re_hour.search(line)
+                if match:
+                    hour = match.group()[:-1]
+        elif not line:
+            reached_content = True
+        elif reached_content:
+            # TODO: Use a pretrained tokenizer instead
+            if line.startswith(PREFIX_URL) and re_url.match(line):
+                line = TOKEN_URL
+            elif '@' in line:
+                line = re_email.sub(TOKEN_EMAIL, line)
+            if re_only_special_char.match(line):
+                line = TOKEN_SYMBOLS
+            content.append(line)
+
+    words = ' '.join(content).translate(special_char_table).split()
+    if profiling.ENABLED:
+        profiling.count('emails')
+        profiling.count('tokens', len(words))
+    return {'words': dict(Counter(words)), 'ip': ip, 'hour': hour}
+
+
 class DataLoader:
-    def __init__(self, index_file, data_size=1.0, shuffle=True):
+    '''
+    workers: # processes used to parse emails, 1 = parse in this process
+    stream: if True, emails are not kept in self.data but parsed lazily
+        each time the loader is iterated over
+    cache: ParseCache, emails in it are not parsed again
+    keep_order: if True, emails are in order of the (shuffled) index file
+        instead of grouped by directory, so that the emails of a smaller
+        data_size are a prefix of them, see self.line_nums
+    shard: (i, n) to keep only the i-th of n contiguous parts of these
+        emails, e.g. to count the training emails on n machines
+    '''
+    def __init__(self, index_file, data_size=1.0, shuffle=True, workers=1, stream=False, cache=None,
+                 keep_order=False, shard=None):
         self.data = []
         self.index_file = index_file
         self.data_size = data_size
         self.shuffle = shuffle
-
-        self.load_data()
-        print(f'[{_file}] Loaded {len(self.data)} examples')
+        self.workers = workers
+        self.stream = stream
+        self.cache = cache
+        self.keep_order = keep_order
+        self.num_lines = 0   # of the index file
+        self.line_keys = []  # (line number after shuffling, dir_0, dir_1)
+
+        self.load_paths()
+        if shard is not None:
+            i, n = shard
+            start, stop = len(self.paths) * i // n, len(self.paths) * (i + 1) // n
+            self.paths = self.paths[start:stop]
+            self.labels = self.labels[start:stop]
+            self.line_nums = self.line_nums[start:stop]
+        if not stream:
+            self.load_data()
+            print(f'[{_file}] Loaded {len(self.data)} examples')
 
     def remove_special_chars(self, s) -> str:
-        # remove = '!"()}{?$#@|%'
-        remove = '&<>.,:;_^-+=/\\*!"()}{?$#@|%'
-        replace_with_space = '&<>.,:;_^-+=/\\*!"()}{?$#@|%'
-        for c in remove:
-            s = s.replace(c, '')
-        for c in replace_with_space:
-            s = s.replace(c, ' ')
-        return s
+        return remove_special_chars(s)
 
     def parse_email(self, filename) -> dict:
-        email = {}
-        email['words'] = {}
-        email['ip'] = None
-        email['hour'] = None
-        f = codecs.open(filename, 'r', 'utf8', errors='ignore')
-
-        re_url = re.compile(
-            r'^(?:http|ftp)s?://' # http:// or https://
-            r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|' #domain...
-            r'localhost|' #localhost...
-            r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})' # ...or ip
-            r'(?::\d+)?' # optional port
-            r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-        re_only_special_char = re.compile('^[\W_]+$')
-        re_email = re.compile('[^@]+@[^@]+\.[^@]+')
-        re_special_char = re.compile('\W')
-
-        # When True, everything afterwards is content
-        reached_content = False
-        for line in f:
-            line = line.strip().lower()
-            # Parse ip
-            if re.match(r'received: from.*', line):
-                ip_re = re.findall(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', line, flags=0)
-                email['ip'] = ip_re[0] if len(ip_re) > 0 else None
-            # Parse time
-            if re.match(r'date: .*', line):
-                if not reached_content:
-                    date_re = re.findall(r'\d+:', line, flags=0)
-                    if len(date_re) > 0:
-                        hour = date_re[0].strip(":")
-                        email['hour'] = hour
-            elif re.match(r'^$', line):
-                reached_content = True
-            elif not reached_content:
-                continue
-                
-            # Parse content
-            # TODO: Use a pretrained tokenizer instead
-            else:
-                line = re.sub(re_url, TOKEN_URL, line)
-                line = re.sub(re_email, TOKEN_EMAIL, line)
-                line = re.sub(re_only_special_char, TOKEN_SYMBOLS, line)
-                line = self.remove_special_chars(line)
-
-                words = line.split()
-
-                for word in words:
-                    # Skip numbers
-                    # if not any(c.isalpha() for c in word):
-                        # Skip all words without letters
-                        # continue
-                    # elif cnt_chars(word) < len(word) // 2:
-                        # Skip all words where less than half of chars
-                        # are special non-letters
-                        # continue
-                    # Count occurrence of word
-                    incr(email['words'], word)
-        f.close()
-        return email
+        return parse_email(filename)
 
     def load_labels(self, filename) -> dict:
         """
@@ -105,10 +158,12 @@ class DataLoader:
         # Shuffle and keep part of dataset based on hyperparameters
         if self.shuffle:
             random.shuffle(lines)
+        self.num_lines = len(lines)
         size = int(len(lines) * self.data_size)
         lines = lines[: size]
 
-        for line in lines:
+        self.line_keys = []
+        for line_num, line in enumerate(lines):
             line = line.strip().split()
             if len(line) < 2:
                 continue
@@ -122,26 +177,72 @@ class DataLoader:
                 labels[dir_0] = {}
             if dir_1 not in labels[dir_0]:
                 labels[dir_0][dir_1] = {}
+                self.line_keys.append((line_num, dir_0, dir_1))
             labels[dir_0][dir_1] = label
         return labels
 
+    def load_paths(self) -> None:
+        """
+        Fix the (shuffled) list of email files and their labels, so that
+        iterating over a streaming loader twice gives the same emails.
+        """
+        labels = self.load_labels(self.index_file)
+        self.paths = []
+        self.labels = []
+        self.line_nums = []  # line of each email in the shuffled index, if keep_order
+        if self.keep_order:
+            for line_num, dir_0, dir_1 in self.line_keys:
+                self.paths.append(os.path.join(DIR_DATA, 'data', dir_0, dir_1))
+                self.labels.append(labels[dir_0][dir_1])
+                self.line_nums.append(line_num)
+            return
+        for dir_0 in labels:
+            for dir_1 in labels[dir_0]:
+                self.paths.append(os.path.join(DIR_DATA, 'data', dir_0, dir_1))
+                self.labels.append(labels[dir_0][dir_1])
+
+    def iter_data(self):
+        """
+        Parse emails lazily, yield Emails (dict) in order of self.paths
+        """
+        print(f'[{_file}] Loading {len(self.paths)} examples...')
+        if self.cache is not None:
+            hits, misses = self.cache.hits, self.cache.misses
+            emails = self.cache.parse_all(self.paths, self.parse_paths)
+        else:
+            emails = self.parse_paths(self.paths)
+        for email, label in zip(tqdm(emails, total=len(self.paths)), self.labels):
+            email['label'] = label
+            yield email
+        if self.cache is not None:
+            hits, misses = self.cache.hits - hits, self.cache.misses - misses
+            print(f'[{_file}] Parse cache: {hits} hits, {misses} misses')
+
+    def parse_paths(self, paths: list):
+        """
+        Parse emails of `paths`, yield them in order of `paths`
+        """
+        if self.workers > 1 and len(paths) > 1:
+            # imap keeps the order of paths, so the result does not depend
+            # on which worker finishes first
+            chunksize = max(1, len(paths) // (self.workers * 16))
+            with Pool(self.workers) as pool:
+                yield from pool.imap(parse_email, paths, chunksize)
+        else:
+            for path in paths:
+                yield parse_email(path)
+
     def load_data(self) -> None:
         """
-        Return list of Emails (dict)
+        Load list of Emails (dict) into self.data
         `index_file`: path to index file
         """
-        labels = self.load_labels(self.index_file)
+        self.data = list(self.iter_data())
 
-        num_examples = 0
-        for x in labels:
-            for y in labels[x]:
-                num_examples += 1
+    def __iter__(self):
+        if self.stream:
+            return self.iter_data()
+        return iter(self.data)
 
-        print(f'[{_file}] Loading {num_examples} examples...')
-        for dir_0 in tqdm(labels):
-            for dir_1 in labels[dir_0]:
-                label = labels[dir_0][dir_1]
-                path = os.path.join(DIR_DATA, 'data', dir_0, dir_1)
-                email = self.parse_email(path)
-                email['label'] = label
-                self.data.append(email)
+    def __len__(self):
+        return len(self.paths)
@@ -0,0 +1,215 @@
+import re
+import sys
+import numpy as np
+from itertools import repeat
+
+
+# Prefix lengths the IP estimates back off to, longest first
+IP_PREFIXES = (32, 24, 16)
+# Default interpolation weights of the estimates of these prefixes
+IP_BACKOFF = (0.6, 0.3, 0.1)
+
+# Comma-separated IPs of 4 parts of 1 to 3 digits, see ips_to_ints
+_ip = r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'
+re_ip_list = re.compile(f'{_ip}(?:,{_ip})*', re.ASCII)
+
+
+def ip_to_int(ip) -> int:
+    '''
+    '1.2.3.4' -> 0x01020304, -1 if `ip` is not an IPv4 address (the parser
+    accepts up to 3 digits, e.g. 999.1.2.3)
+    '''
+    try:
+        a, b, c, d = map(int, ip.split('.'))
+    except (AttributeError, ValueError):
+        return -1
+    if not 0 <= min(a, b, c, d) <= max(a, b, c, d) <= 255:
+        return -1
+    return (a << 24) | (b << 16) | (c << 8) | d
+
+
+def ips_to_ints(ips) -> np.ndarray:
+    '''
+    ip_to_int of each of `ips`. IPs as parsed by parse_email (4 parts of 1
+    to 3 digits) are parsed all at once, others one at a time.
+    '''
+    ips = list(ips)
+    try:
+        text = ','.join(ips)
+    except TypeError:
+        text = ''
+    if not re_ip_list.fullmatch(text):
+        return np.fromiter(map(ip_to_int, ips), dtype=np.int64, count=len(ips))
+    parts = np.fromstring(text.replace(',', '.'), dtype=np.int64, sep='.').reshape(-1, 4)
+    ints = (parts[:, 0] << 24) | (parts[:, 1] << 16) | (parts[:, 2] << 8) | parts[:, 3]
+    return np.where((parts <= 255).all(axis=1), ints, -1)
+
+
+class IPIndex:
+    '''
+    IP counts of each label by prefix (/32, /24, /16), so that IPs never
+    seen in training still get the counts of their subnet.
+
+    For each prefix length: a dict from the prefixes seen (IPs as 32-bit
+    ints, masked to the prefix length) to rows of a (# prefixes, # labels)
+    count matrix, so looking up an IP costs one dict access per prefix
+    length whatever the number of prefixes.
+
+    log P(ip|C) interpolates the smoothed estimates of the prefixes of ip:
+        P(ip|C) = sum_l weights[l] * (cnt_l(C, ip) + s) / (N_C + K_l * s)
+    N_C: # emails of label C with an IP, K_l: # distinct prefixes of
+    length l, s: smoothing factor. Prefix lengths without any prefix
+    (no IPv4 IP in training) are left out of the sum, and log P(ip|C) is 0
+    if there are none at all, as for emails without IP.
+    '''
+    def __init__(self, label_ip_cnts: dict, labels: list, weights=IP_BACKOFF,
+                 prefixes=IP_PREFIXES):
+        assert len(weights) == len(prefixes)
+        self.labels = labels
+        self.prefixes = prefixes
+        self.weights = np.array(weights, dtype=np.float64) / sum(weights)
+        self.masks = [(0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF for length in prefixes]
+
+        ips = []
+        label_ids = []
+        cnts = []
+        for j, label in enumerate(labels):
+            for ip, cnt in label_ip_cnts[label].items():
+                ips.append(ip)
+                label_ids.append(j)
+                cnts.append(cnt)
+        ips = ips_to_ints(ips)
+        label_ids = np.array(label_ids, dtype=np.int64)
+        cnts = np.array(cnts, dtype=np.int64)
+        # IPs that are not IPv4 count in N_C too
+        self.label_totals = np.bincount(label_ids, cnts, minlength=len(labels))
+        self.denom = None  # (smoothing factor, denominators of logp)
+
+        valid = ips >= 0
+        ips, label_ids, cnts = ips[valid], label_ids[valid], cnts[valid]
+        self.rows = []  # [{prefix: row in cnts}], for each prefix length
+        self.cnts = []  # [(# prefixes, # labels) int64]
+        for mask in self.masks:
+            keys, inverse = np.unique(ips & mask, return_inverse=True)
+            level_cnts = np.bincount(
+                inverse * len(labels) + label_ids, cnts, minlength=len(keys) * len(labels))
+            self.rows.append(dict(zip(keys.tolist(), range(len(keys)))))
+            self.cnts.append(level_cnts.astype(np.int64).reshape(len(keys), len(labels)))
+        # Rows of cnts in use (some may be free) and rows freed by add()
+        self.num_rows = [len(rows) for rows in self.rows]
+        self.free_rows = [[] for _ in prefixes]
+
+    def add(self, ip, label, cnt=1) -> None:
+        '''
+        Add `cnt` emails of `label` with `ip` (remove them if negative) to
+        the counts in place. Prefixes whose counts all drop to 0 are
+        removed, as if never seen.
+        '''
+        j = self.labels.index(label)
+        self.label_totals[j] += cnt
+        self.denom = None
+        ip = ip_to_int(ip)
+        if ip < 0:
+            return
+        for level, mask in enumerate(self.masks):
+            rows = self.rows[level]
+            prefix = ip & mask
+            i = rows.get(prefix)
+            if i is None:
+                i = rows[prefix] = self.new_row(level)
+            cnts = self.cnts[level]
+            cnts[i, j] += cnt
+            if not cnts[i].any():
+                del rows[prefix]
+                self.free_rows[level].append(i)
+
+    def new_row(self, level: int) -> int:
+        '''
+        Return a row of zeros of the counts of `level`, the count matrix
+        doubles when full
+        '''
+        if self.free_rows[level]:
+            return self.free_rows[level].pop()
+        cnts = self.cnts[level]
+        i = self.num_rows[level]
+        if i == len(cnts):
+            more = np.zeros((max(i, 1), len(self.labels)), dtype=cnts.dtype)
+            self.cnts[level] = np.concatenate([cnts, more])
+        self.num_rows[level] += 1
+        return i
+
+    def counts(self, ips) -> np.ndarray:
+        '''
+        Return counts of the prefixes of `ips`, shape
+        (# ips, # prefix lengths, # labels), 0 for IPs that are not IPv4
+        '''
+        if len(ips) == 1:
+            return self.counts_one(ips[0])
+        ips = ips_to_ints(ips)
+        valid = ips >= 0
+        result = np.zeros((len(ips), len(self.prefixes), len(self.labels)), dtype=np.int64)
+        for level, (mask, rows, cnts) in enumerate(zip(self.masks, self.rows, self.cnts)):
+            if not rows:
+                continue
+            prefixes = (ips & mask).tolist()
+            i = np.fromiter(map(rows.get, prefixes, repeat(-1)), dtype=np.int64, count=len(ips))
+            hit = valid & (i >= 0)
+            result[hit, level] = cnts[i[hit]]
+        return result
+
+    def counts_one(self, ip) -> np.ndarray:
+        '''
+        counts() of a single IP (classify), with scalar lookups
+        '''
+        result = np.zeros((1, len(self.prefixes), len(self.labels)), dtype=np.int64)
+        ip = ip_to_int(ip)
+        if ip < 0:
+            return result
+        for level, (mask, rows, cnts) in enumerate(zip(self.masks, self.rows, self.cnts)):
+            i = rows.get(ip & mask)
+            if i is not None:
+                result[0, level] = cnts[i]
+        return result
+
+    def denominators(self, smooth_factor: float) -> tuple:
+        '''
+        Return (weights of the prefix lengths, denominators of shape
+        (# prefix lengths, # labels)), None if there is no prefix at all
+        '''
+        num_prefixes = np.array([len(rows) for rows in self.rows], dtype=np.float64)
+        if not num_prefixes.any():
+            return None
+        if self.denom is None or self.denom[0] != smooth_factor:
+            # 1 for the levels left out
+            denom = self.label_totals[None, :] + num_prefixes[:, None] * smooth_factor
+            self.denom = (smooth_factor, np.where(num_prefixes[:, None] > 0, denom, 1.0))
+        weights = np.where(num_prefixes > 0, self.weights, 0.0)
+        return weights / weights.sum(), self.denom[1]
+
+    def logp(self, ips, smooth_factor: float) -> np.ndarray:
+        '''
+        Return log P(ip|C) of each of `ips` and label, shape (# ips, # labels)
+        '''
+        denominators = self.denominators(smooth_factor)
+        if denominators is None:
+            return np.zeros((len(ips), len(self.labels)))
+        weights, denom = denominators
+        p = (self.counts(ips) + smooth_factor) / denom
+        return np.log(np.einsum('l,nlc->nc', weights, p))
+
+    def logp_bounds(self, smooth_factor: float) -> tuple:
+        '''
+        Return (min, max) over all IPs of log P(ip|C), arrays of shape
+        (# labels,): counts of 0, and the max count of each prefix length
+        '''
+        denominators = self.denominators(smooth_factor)
+        if denominators is None:
+            return np.zeros(len(self.labels)), np.zeros(len(self.labels))
+        weights, denom = denominators
+        max_cnts = np.array([cnts.max(axis=0) if len(cnts) else np.zeros(len(self.labels))
+                             for cnts in self.cnts])
+        return (np.log(weights @ (smooth_factor / denom)),
+                np.log(weights @ ((max_cnts + smooth_factor) / denom)))
+
+    def nbytes(self) -> int:
+        return sum(sys.getsizeof(rows) + cnts.nbytes for rows, cnts in zip(self.rows, self.cnts))
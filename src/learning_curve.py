@@ -0,0 +1,94 @@
+'''
+Learning curve: test the classifier trained on each proportion of the
+training data given by --sizes, parsing and counting the training emails
+only once.
+
+The training set of preprocess.py --data_size X is the first X of the
+shuffled train index. The emails are counted in that order and the model
+is built and tested on the dev dataset each time a proportion is
+reached, so each row is the same as running preprocess.py --data_size X
+and then test.py.
+
+    python3 learning_curve.py --sizes 0.01 0.05 0.2 0.5 1.0
+'''
+import os
+import random
+import argparse
+from config import *
+from utils import *
+from dataloader import DataLoader
+from parse_cache import ParseCache
+from preprocess import CorpusStats
+from test import add_model_args, model_params, test_classifier
+
+
+_file = '[' + os.path.basename(__file__) + ']'
+
+
+def learning_curve(args):
+    # Same shuffles as preprocess.py: dev index first, then train index
+    random.seed(SEED)
+    cache = None if args.no_cache else ParseCache(FILE_PARSE_CACHE)
+    dev_dataset = DataLoader(FILE_INDEX_DEV, workers=args.workers, cache=cache).data
+    loader = DataLoader(
+        FILE_INDEX_TRAIN, workers=args.workers, stream=True, cache=cache, keep_order=True)
+
+    params = model_params(args)
+    sizes = sorted(args.sizes)
+    # Emails on lines before this in the shuffled index are in the subset
+    ends = [int(loader.num_lines * size) for size in sizes]
+
+    rows = []
+    stats = CorpusStats()
+
+    def snapshot():
+        size = sizes[len(rows)]
+        print(_file, f'data_size = {size}: {stats.num_docs} examples')
+        classifier = stats.build_classifier(**params)
+        rows.append((size, stats.num_docs, len(stats.vocab),
+                     test_classifier(classifier, dev_dataset)))
+
+    for line_num, email in zip(loader.line_nums, loader):
+        while len(rows) < len(sizes) and line_num >= ends[len(rows)]:
+            snapshot()
+        if len(rows) == len(sizes):
+            break
+        stats.add(email)
+    while len(rows) < len(sizes):
+        snapshot()
+
+    print(f'{"data_size":>9} {"# train":>8} {"vocab":>8} '
+          f'{"accuracy":>9} {"macro_f1":>9} {"micro_f1":>9} {"recall":>9}')
+    for size, num_train, vocab_size, scores in rows:
+        print(f'{size:9g} {num_train:8d} {vocab_size:8d} '
+              f'{scores["acc"]*100:9.3f} {scores["macro_f1"]*100:9.3f} '
+              f'{scores["micro_f1"]*100:9.3f} {scores["recall"]*100:9.3f}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--sizes',
+        help='proportions of the training data',
+        type=float,
+        nargs='+',
+        default=[0.01, 0.05, 0.2, 0.5, 1.0],
+    )
+    parser.add_argument(
+        '--workers',
+        help='number of processes used to parse emails',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--no_cache',
+        help='parse every email again instead of reading the parse cache',
+        action='store_true',
+    )
+    add_model_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    learning_curve(args)
@@ -0,0 +1,189 @@
+import os
+import pickle
+import profiling
+from dataloader import PARSE_VERSION
+
+
+# First record of a cache file, files of another version are discarded
+CACHE_HEADER = ('parse_cache', PARSE_VERSION)
+
+
+class ParseCache:
+    '''
+    On-disk cache of parse_email outputs, so that emails are parsed only
+    once across runs (e.g. preprocess.py with different --data_size).
+
+    Entries are keyed by path and validated by the mtime and size of the
+    file, a changed file is parsed again. The file starts with
+    CACHE_HEADER, the whole cache is dropped if it was written by another
+    version of the parser (dataloader.PARSE_VERSION). It is followed by a
+    sequence of records: a pickled header (path, mtime_ns, size, length)
+    followed by the pickled email, `length` bytes. New records are
+    appended, a later record of a path replaces the earlier ones.
+
+    Only an index of the records is kept in memory, emails are read from
+    the file when they are needed, so that a streaming DataLoader keeps a
+    bounded memory.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = {}  # {path: (mtime_ns, size, offset of the email, length)}
+        self.hits = 0
+        self.misses = 0
+        self.file = None    # appended to
+        self.reader = None
+        self.end = 0        # size of the file, offset of the next record
+        self.unflushed = False
+        self.load()
+
+    def load(self) -> None:
+        if not os.path.exists(self.filename):
+            return
+        num_records = 0
+        file_size = os.path.getsize(self.filename)
+        with open(self.filename, 'rb') as f:
+            try:
+                header = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError, ValueError, TypeError):
+                header = None
+            valid = header == CACHE_HEADER
+            end = f.tell()
+            while valid:
+                try:
+                    path, mtime, size, length = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, TypeError):
+                    # Truncated last record of an interrupted run
+                    break
+                if not isinstance(length, int):
+                    break
+                offset = f.tell()
+                if offset + length > file_size:
+                    break
+                f.seek(length, os.SEEK_CUR)
+                self.index[path] = (mtime, size, offset, length)
+                num_records += 1
+                end = f.tell()
+        if not valid:
+            # Older parser or file format: parse every email again
+            os.remove(self.filename)
+            return
+        self.end = end
+        if end < file_size or num_records > 2 * len(self.index):
+            self.compact()
+
+    def compact(self) -> None:
+        '''
+        Rewrite the file with only the latest record of each path
+        '''
+        self.close()
+        tmp = self.filename + '.tmp'
+        index = {}
+        with open(self.filename, 'rb') as src, open(tmp, 'wb') as f:
+            pickle.dump(CACHE_HEADER, f, pickle.HIGHEST_PROTOCOL)
+            for path, (mtime, size, offset, length) in self.index.items():
+                src.seek(offset)
+                pickle.dump((path, mtime, size, length), f, pickle.HIGHEST_PROTOCOL)
+                index[path] = (mtime, size, f.tell(), length)
+                f.write(src.read(length))
+            end = f.tell()
+        os.replace(tmp, self.filename)
+        self.index = index
+        self.end = end
+
+    def lookup(self, path, stat=None):
+        '''
+        Return (offset, length) of the cached email of `path`, None if not
+        cached or the file has changed since
+        '''
+        stat = stat or os.stat(path)
+        entry = self.index.get(path)
+        if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+            self.misses += 1
+            if profiling.ENABLED:
+                profiling.count('parse_cache.miss')
+            return None
+        self.hits += 1
+        if profiling.ENABLED:
+            profiling.count('parse_cache.hit')
+        return entry[2:]
+
+    @profiling.timed('parse_cache.read')
+    def read(self, offset: int, length: int) -> dict:
+        '''
+        Return the email of the record at `offset`, a new dict (with its
+        own words) on every call, so the caller may change it
+        '''
+        if self.unflushed:
+            self.flush()
+        if self.reader is None:
+            self.reader = open(self.filename, 'rb')
+        self.reader.seek(offset)
+        return pickle.loads(self.reader.read(length))
+
+    def get(self, path, stat=None):
+        '''
+        Return cached email of `path`, None if not cached or the file
+        has changed since
+        '''
+        location = self.lookup(path, stat)
+        if location is None:
+            return None
+        return self.read(*location)
+
+    def put(self, path, email, stat=None) -> None:
+        stat = stat or os.stat(path)
+        if self.file is None:
+            dirname = os.path.dirname(self.filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self.file = open(self.filename, 'ab')
+            if self.end == 0:
+                header = pickle.dumps(CACHE_HEADER, pickle.HIGHEST_PROTOCOL)
+                self.file.write(header)
+                self.end = len(header)
+        email = {k: v for k, v in email.items() if k != 'label'}
+        data = pickle.dumps(email, pickle.HIGHEST_PROTOCOL)
+        header = pickle.dumps(
+            (path, stat.st_mtime_ns, stat.st_size, len(data)), pickle.HIGHEST_PROTOCOL)
+        self.file.write(header)
+        self.file.write(data)
+        self.index[path] = (stat.st_mtime_ns, stat.st_size, self.end + len(header), len(data))
+        self.end += len(header) + len(data)
+        self.unflushed = True
+
+    def parse_all(self, paths: list, parse_paths):
+        '''
+        Yield emails of `paths` in order, reading them from the cache one
+        at a time and parsing the others with `parse_paths` (generator over
+        a list of paths, e.g. parsing in parallel).
+        '''
+        stats = [os.stat(path) for path in paths]
+        locations = [self.lookup(path, stat) for path, stat in zip(paths, stats)]
+        missed = [path for path, location in zip(paths, locations) if location is None]
+        parsed = parse_paths(missed)
+        for path, stat, location in zip(paths, stats, locations):
+            if location is None:
+                email = next(parsed)
+                self.put(path, email, stat)
+            else:
+                email = self.read(*location)
+            yield email
+        self.flush()
+
+    def flush(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+        self.unflushed = False
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def __len__(self):
+        return len(self.index)
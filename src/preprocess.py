@@ -1,21 +1,367 @@
 import re
 import os
+import json
 import pickle
 import argparse
 import random
 import math
+import numpy as np
+from collections import Counter
 from tqdm import tqdm
 from config import *
 from utils import *
 from dataloader import DataLoader
+from parse_cache import ParseCache
+from vocab import Vocabulary, HashedVocabulary
+from corpus import Corpus
+import profiling
+from classifier import NaiveBayesClassifier
 
 
 _file = '[' + os.path.basename(__file__) + ']'
 
+# Word ids of the emails that CorpusStats counts at once, see flush
+MAX_PENDING_IDS = 2 ** 20
+
 
 random.seed(SEED)
 
 
+class CorpusStats:
+    '''
+    Word, document frequency, label, IP and hour counts of a set of emails,
+    collected in a single pass. Stats of disjoint sets of emails can be
+    merged, e.g. partial stats from parallel workers.
+
+    NOTE: each email counts a word once, so the global word counts are
+    also the document frequencies used for IDF.
+
+    Words are mapped to ids by self.vocab (a Vocabulary, ids in order of
+    first occurrence) and word counts are arrays indexed by id, as in
+    NaiveBayesClassifier. Emails are added to the arrays in batches (see
+    flush): use counts(), or the arrays after update().
+
+    hash_buckets: if given, words are counted in this many hash buckets
+        (HashedVocabulary) instead of per word, word counts are then arrays
+        of fixed size indexed by bucket.
+    '''
+    def __init__(self, hash_buckets=None):
+        self.num_docs = 0
+        self.hash_buckets = hash_buckets
+        if hash_buckets:
+            self.vocab = HashedVocabulary(hash_buckets)
+        else:
+            self.vocab = Vocabulary()
+        size = len(self.vocab)
+        self.word_cnts = np.zeros(size, dtype=np.int64)     # (len(vocab),)
+        self.label_word_cnts = {label: np.zeros(size, dtype=np.int64) for label in (0, 1)}
+        self.pending = []       # [(label, word ids)] of the emails added since the last flush
+        self.num_pending = 0    # of word ids
+        self.label_cnts = Counter()                         # {label: cnt}
+        self.label_ip_cnts = {0: Counter(), 1: Counter()}   # {label: {ip: cnt}}
+        self.label_time_cnts = {0: Counter(), 1: Counter()} # {label: {hour: cnt}}
+
+    def grow(self) -> None:
+        '''
+        Extend the word arrays to the words newly added to self.vocab
+        '''
+        size = len(self.vocab)
+        if size == len(self.word_cnts):
+            return
+        self.word_cnts = padded(self.word_cnts, size)
+        for label in self.label_word_cnts:
+            self.label_word_cnts[label] = padded(self.label_word_cnts[label], size)
+
+    def flush(self) -> None:
+        '''
+        Add the word ids of the pending emails to the word arrays, with
+        one bincount per label: updating the arrays for each email costs
+        more than counting the email.
+        '''
+        if not self.pending:
+            return
+        self.grow()
+        for label in self.label_word_cnts:
+            ids = [ids for pending_label, ids in self.pending if pending_label == label]
+            if ids:
+                cnts = np.bincount(np.concatenate(ids), minlength=len(self.vocab))
+                self.label_word_cnts[label] += cnts
+                self.word_cnts += cnts
+        self.pending = []
+        self.num_pending = 0
+
+    def counts(self) -> tuple:
+        '''
+        Return (word counts, {label: word counts}), arrays of shape
+        (len(vocab),)
+        '''
+        self.flush()
+        return self.word_cnts, self.label_word_cnts
+
+    @profiling.timed('corpus_stats.add')
+    def add(self, email: dict) -> None:
+        label = email['label']
+        if label not in self.label_word_cnts:
+            print(f'[{_file}] Invalid label: {label}')
+            print(f'[{_file}] Should be 0 or 1')
+            exit(0)
+        self.num_docs += 1
+        words = email['words']
+        if self.hash_buckets:
+            # Words of an email may share a bucket, counted once as a word
+            ids = np.unique(self.vocab.lookup(words.keys()))
+        else:
+            ids = np.fromiter(map(self.vocab.add, words), dtype=np.int64, count=len(words))
+        self.pending.append((label, ids))
+        self.num_pending += len(ids)
+        if self.num_pending >= MAX_PENDING_IDS:
+            self.flush()
+        self.label_cnts[label] += 1
+        if email['ip'] is not None:
+            self.label_ip_cnts[label][email['ip']] += 1
+        if email['hour'] is not None:
+            self.label_time_cnts[label][email['hour']] += 1
+
+    def update(self, dataset):
+        '''
+        Add every email in `dataset`, any iterable of emails (e.g. a
+        streaming DataLoader).
+        '''
+        for email in dataset:
+            self.add(email)
+        self.flush()
+        return self
+
+    def merge(self, other):
+        '''
+        Add the counts of `other` to these stats. Words new to these stats
+        are added in the order of other.vocab.
+        '''
+        self.num_docs += other.num_docs
+        word_cnts, label_word_cnts = other.counts()
+        self.flush()
+        if self.hash_buckets:
+            ids = slice(None)
+        else:
+            ids = np.fromiter(map(self.vocab.add, other.vocab), dtype=np.int64, count=len(other.vocab))
+            self.grow()
+        self.word_cnts[ids] += word_cnts
+        self.label_cnts.update(other.label_cnts)
+        for label in self.label_word_cnts:
+            self.label_word_cnts[label][ids] += label_word_cnts[label]
+            self.label_ip_cnts[label].update(other.label_ip_cnts[label])
+            self.label_time_cnts[label].update(other.label_time_cnts[label])
+        return self
+
+    def subtract(self, other):
+        '''
+        Remove the counts of `other`, which must be a subset of the emails
+        of these stats. Words and keys whose count drops to 0 are removed.
+        '''
+        self.num_docs -= other.num_docs
+        word_cnts, label_word_cnts = other.counts()
+        self.flush()
+        ids = slice(None) if self.hash_buckets else self.vocab.lookup(other.vocab)
+        self.word_cnts[ids] -= word_cnts
+        self.label_cnts -= other.label_cnts
+        for label in self.label_word_cnts:
+            self.label_word_cnts[label][ids] -= label_word_cnts[label]
+            self.label_ip_cnts[label] -= other.label_ip_cnts[label]
+            self.label_time_cnts[label] -= other.label_time_cnts[label]
+        if not self.hash_buckets:
+            self.keep_words(np.flatnonzero(self.counts()[0] > 0))
+        return self
+
+    def keep_words(self, ids: np.ndarray) -> None:
+        '''
+        Drop all words but `ids` (increasing), which keep their order
+        '''
+        self.flush()
+        words = self.vocab.words
+        self.vocab = Vocabulary(words[i] for i in ids.tolist())
+        self.word_cnts = self.word_cnts[ids]
+        for label in self.label_word_cnts:
+            self.label_word_cnts[label] = self.label_word_cnts[label][ids]
+
+    def copy(self):
+        return CorpusStats(self.hash_buckets).merge(self)
+
+    def save(self, filename, meta=None) -> None:
+        '''
+        Save the counts to `filename` (.npz) with `meta` (any JSON), to be
+        loaded and merged elsewhere. Words are saved in order of id (first
+        occurrence) with the count arrays, so that merging loaded stats in
+        order gives the same stats as counting all their emails in one pass.
+        '''
+        labels = list(self.label_word_cnts)
+        header = {
+            'meta': meta,
+            'num_docs': self.num_docs,
+            'hash_buckets': self.hash_buckets,
+            'label_cnts': list(self.label_cnts.items()),
+            'label_ip_cnts': [list(self.label_ip_cnts[label].items()) for label in labels],
+            'label_time_cnts': [list(self.label_time_cnts[label].items()) for label in labels],
+        }
+        word_cnts, label_word_cnts = self.counts()
+        arrays = {
+            'header': np.frombuffer(json.dumps(header).encode('utf8'), dtype=np.uint8),
+            'word_cnts': word_cnts,
+        }
+        for label in labels:
+            arrays[f'label_word_cnts_{label}'] = label_word_cnts[label]
+        if not self.hash_buckets:
+            arrays['words'] = np.frombuffer(self.vocab.to_bytes(), dtype=np.uint8)
+        np.savez_compressed(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename) -> tuple:
+        '''
+        Return (stats, meta) saved by save()
+        '''
+        with np.load(filename) as arrays:
+            header = json.loads(arrays['header'].tobytes().decode('utf8'))
+            stats = cls(header['hash_buckets'])
+            stats.num_docs = header['num_docs']
+            stats.label_cnts.update(dict(header['label_cnts']))
+            labels = list(stats.label_word_cnts)
+            for label, ip_cnts, time_cnts in zip(
+                    labels, header['label_ip_cnts'], header['label_time_cnts']):
+                stats.label_ip_cnts[label].update(dict(ip_cnts))
+                stats.label_time_cnts[label].update(dict(time_cnts))
+            if not stats.hash_buckets:
+                stats.vocab = Vocabulary.from_bytes(arrays['words'])
+            stats.word_cnts = arrays['word_cnts']
+            for label in labels:
+                stats.label_word_cnts[label] = arrays[f'label_word_cnts_{label}']
+        return stats, header['meta']
+
+    @profiling.timed('corpus_stats.build_classifier')
+    def build_classifier(self, **kwargs) -> NaiveBayesClassifier:
+        '''
+        `kwargs`: smooth_factor, use_ip, etc. as for NaiveBayesClassifier
+        '''
+        label_cnts = self.get_label_cnts()
+        word_cnts, label_word_cnts = self.counts()
+        # Copies, the classifier updates its counts and vocab (partial_fit)
+        # while these stats may still count more emails
+        vocab = self.vocab if self.hash_buckets else Vocabulary(self.vocab)
+        classifier = NaiveBayesClassifier(
+            label_cnts,
+            word_cnts.copy(),
+            np.stack([label_word_cnts[label] for label in label_cnts]),
+            self.get_label_ip_cnts(),
+            self.get_label_time_cnts(),
+            None,
+            vocab=vocab,
+            **kwargs)
+        # IDF from the counts
+        classifier.idf_stale = True
+        classifier.build_idf()
+        return classifier
+
+    def prune(self, min_df=1, max_vocab=None, rank_by='count', min_letter_ratio=0.0):
+        '''
+        Return copy of these stats without the pruned words:
+        `min_df`: drop words in fewer emails
+        `min_letter_ratio`: drop words where less than this proportion of
+            chars are letters (numbers, junk strings), special tokens are kept
+        `max_vocab`: keep at most this many words, those with the highest
+            document frequency (`rank_by` = 'count') or information gain
+            about the label ('info_gain')
+        '''
+        if self.hash_buckets:
+            raise ValueError('Hashed word counts cannot be pruned')
+        word_cnts, _ = self.counts()
+        ids = np.flatnonzero(word_cnts >= min_df)
+        if min_letter_ratio > 0:
+            words = self.vocab.words
+            ids = np.array([i for i in ids.tolist()
+                            if words[i] in SPECIAL_TOKENS
+                            or cnt_chars(words[i]) >= min_letter_ratio * len(words[i])],
+                           dtype=np.int64)
+        if max_vocab is not None and len(ids) > max_vocab:
+            if rank_by == 'count':
+                scores = word_cnts[ids]
+            elif rank_by == 'info_gain':
+                scores = self.info_gain(ids)
+            else:
+                raise ValueError(f'Unknown rank_by {rank_by}, should be count or info_gain')
+            # Stable, ties are kept in order of occurrence
+            ids = np.sort(ids[np.argsort(-scores, kind='stable')[:max_vocab]])
+
+        pruned = self.copy()
+        pruned.keep_words(ids)
+        return pruned
+
+    def info_gain(self, ids: np.ndarray) -> np.ndarray:
+        '''
+        Return information gain of the label from the presence of each
+        word of `ids`
+        '''
+        labels = sorted(self.label_cnts)
+        _, label_word_cnts = self.counts()
+        # (# labels, # words) counts of emails with / without each word
+        df = np.stack([label_word_cnts[label][ids] for label in labels]).astype(np.float64)
+        label_cnts = np.array([self.label_cnts[label] for label in labels], dtype=np.float64)
+        no_df = label_cnts[:, None] - df
+        n = self.num_docs
+        cond_entropy = (df.sum(axis=0) * entropy(df) + no_df.sum(axis=0) * entropy(no_df)) / n
+        return entropy(label_cnts[:, None]) - cond_entropy
+
+    def sorted_words(self, cnts: np.ndarray) -> list:
+        '''
+        Return [(word, cnt)] of the words with cnt > 0, sorted by cnt, ties
+        in order of id
+        '''
+        ids = np.flatnonzero(cnts > 0)
+        ids = ids[np.argsort(-cnts[ids], kind='stable')]
+        words = self.vocab.words
+        return [(words[i], cnt) for i, cnt in zip(ids.tolist(), cnts[ids].tolist())]
+
+    def get_words(self) -> tuple:
+        '''
+        Return (words_all, words_0, words_1), lists of (word, cnt) sorted
+        by cnt, as saved to FILE_GLOBAL_WORD_CNTS, FILE_WORDS_0, FILE_WORDS_1
+        '''
+        word_cnts, label_word_cnts = self.counts()
+        return (self.sorted_words(word_cnts),
+                self.sorted_words(label_word_cnts[0]),
+                self.sorted_words(label_word_cnts[1]))
+
+    def get_idf(self) -> dict:
+        idf = {}  # {t: idf(t)}
+        for t, cnt in zip(self.vocab.words, self.counts()[0].tolist()):
+            if cnt > 0:
+                idf[t] = math.log(self.num_docs / cnt)
+        return idf
+
+    def get_label_cnts(self) -> dict:
+        return dict(self.label_cnts)
+
+    def get_label_ip_cnts(self) -> dict:
+        return {label: dict(cnts) for label, cnts in self.label_ip_cnts.items()}
+
+    def get_label_time_cnts(self) -> dict:
+        return {label: dict(cnts) for label, cnts in self.label_time_cnts.items()}
+
+
+def padded(arr: np.ndarray, size: int) -> np.ndarray:
+    '''
+    Copy of `arr` with zeros at the end, up to `size`
+    '''
+    return np.concatenate([arr, np.zeros(size - len(arr), dtype=arr.dtype)])
+
+
+def entropy(cnts: np.ndarray) -> np.ndarray:
+    '''
+    Entropy of each column of counts
+    '''
+    total = cnts.sum(axis=0)
+    p = np.divide(cnts, total, out=np.zeros_like(cnts), where=total > 0)
+    logp = np.log(p, out=np.zeros_like(p), where=p > 0)
+    return -(p * logp).sum(axis=0)
+
+
 def get_words(dataset):
     '''
     Count occurence of each word
@@ -25,29 +371,7 @@ def get_words(dataset):
     c: {word_i: occurence of word_i in examples with label=1, }
     '''
     print(_file, 'Counting words occurences...')
-    words_all = {}
-    words_0 = {}
-    words_1 = {}
-
-    for email in tqdm(dataset):
-        label = email['label']
-        
-        for word in email['words']:
-            incr(words_all, word)
-            
-            if label == 0:
-                incr(words_0, word)
-            elif label == 1:
-                incr(words_1, word)
-            else:
-                print(f'[{_file}] Invalid label: {label}')
-                print(f'[{_file}] Should be 0 or 1')
-                exit(0)
-
-    words_all = sorted(words_all.items(), key=lambda x:x[1], reverse=True)
-    words_0 = sorted(words_0.items(), key=lambda x:x[1], reverse=True)
-    words_1 = sorted(words_1.items(), key=lambda x:x[1], reverse=True)
-    return words_all, words_0, words_1
+    return CorpusStats().update(tqdm(dataset)).get_words()
 
 
 def get_idf(dataset):
@@ -56,90 +380,98 @@ def get_idf(dataset):
     Return: {word: idf(word), }
     '''
     print(_file, 'Computing IDF...')
-    cnt = {}  # {t: 含 t 文数)}
-    for email in dataset:
-        for word in set(email['words']):
-            incr(cnt, word, 1)
-    idf = {}  # {t: idf(t)}
-    D = len(dataset)
-    for t in cnt:
-        idf[t] = math.log(D / cnt[t])
-    return idf
+    return CorpusStats().update(dataset).get_idf()
 
 
 def get_label_cnts(dataset: list) -> dict:
-    label_cnts = {}
-    for email in dataset:
-        incr(label_cnts, email['label'], 1)
-    return label_cnts
+    return CorpusStats().update(dataset).get_label_cnts()
 
 
 def get_label_time_cnts(dataset: list) -> dict:
-    label_time_cnts = {0: {}, 1: {}}
-    for email in dataset:
-        label = email['label']
-        if email['hour'] is not None:
-            incr(label_time_cnts[label], email['hour'], 1)
-    return label_time_cnts
+    return CorpusStats().update(dataset).get_label_time_cnts()
 
 
 def get_label_ip_cnts(dataset: list) -> dict:
-    label_ip_cnts = {0: {}, 1: {}}
-    for email in dataset:
-        label = email['label']
-        if email['ip'] is not None:
-            incr(label_ip_cnts[label], email['ip'], 1)
-    return label_ip_cnts
+    return CorpusStats().update(dataset).get_label_ip_cnts()
 
 
-def process_dev():
+def process_dev(workers=1, cache=None):
     '''
     Process dev dataset, this needs to be run only once
     '''
-    loader = DataLoader(FILE_INDEX_DEV)
-    pickle_save(loader.data, FILE_DEV_DATASET)
+    loader = DataLoader(FILE_INDEX_DEV, workers=workers, cache=cache)
+    Corpus.from_emails(loader.data).save(FILE_DEV_CORPUS)
     return loader.data
 
 
 def preprocess(args):
-    dev_dataset = process_dev()
+    cache = None if args.no_cache else ParseCache(FILE_PARSE_CACHE)
+    dev_dataset = process_dev(args.workers, cache)
     print(f'Loading data with data_size = {100 * args.data_size}%')
-    train_loader = DataLoader(FILE_INDEX_TRAIN, args.data_size)
-    train_dataset = train_loader.data
+    train_loader = DataLoader(
+        FILE_INDEX_TRAIN, args.data_size, workers=args.workers, stream=args.stream, cache=cache)
 
-    print(_file, f'# Train ex.: {len(train_dataset)}')
+    print(_file, f'# Train ex.: {len(train_loader)}')
 
-    words_all, words_0, words_1 = get_words(train_dataset)
-    idf = get_idf(train_dataset)
+    print(_file, 'Counting words, IDF, labels, IP and time...')
+    stats = CorpusStats(args.hash_buckets).update(train_loader)
+    if not args.stream:
+        # Not needed by the classifier, and not kept in memory when streaming
+        Corpus.from_emails(train_loader.data).save(FILE_TRAIN_CORPUS)
+    save_processed(stats, args)
 
-    label_cnts = get_label_cnts(train_dataset)
-    label_ip_cnts = get_label_ip_cnts(train_dataset)
-    label_time_cnts = get_label_time_cnts(train_dataset)
+
+def save_processed(stats: CorpusStats, args) -> None:
+    '''
+    Save the label, IP and time counts, the words and IDF (pruned as given
+    by `args`, unless the words are hashed) and the model of the training stats to DIR_PROCESSED
+    '''
+    label_cnts = stats.get_label_cnts()
+    label_ip_cnts = stats.get_label_ip_cnts()
+    label_time_cnts = stats.get_label_time_cnts()
     print(_file, 'Label counts:', label_cnts)
-    print(_file, 'Vocab size:', len(words_all))
-    # Save
     print(_file, 'Saving pre-processed data to', DIR_PROCESSED)
     if not os.path.exists(DIR_PROCESSED):
         os.makedirs(DIR_PROCESSED)
-    pickle_save(train_dataset, FILE_TRAIN_DATASET)
-    pickle_save(words_all, FILE_GLOBAL_WORD_CNTS)
-    pickle_save(words_0, FILE_WORDS_0)
-    pickle_save(words_1, FILE_WORDS_1)
     pickle_save(label_cnts, FILE_LABEL_CNTS)
     pickle_save(label_ip_cnts, FILE_LABEL_IP_CNTS)
     pickle_save(label_time_cnts, FILE_LABEL_TIME_CNTS)
-    pickle_save(idf, FILE_IDF)
+    if stats.hash_buckets:
+        # Words are not kept, the bucket counts are only in the model file
+        print(_file, 'Hash buckets:', stats.hash_buckets)
+    else:
+        stats = stats.prune(args.min_df, args.max_vocab, args.rank_by, args.min_letter_ratio)
+        words_all, words_0, words_1 = stats.get_words()
+        print(_file, 'Vocab size:', len(words_all))
+        pickle_save(words_all, FILE_GLOBAL_WORD_CNTS)
+        pickle_save(words_0, FILE_WORDS_0)
+        pickle_save(words_1, FILE_WORDS_1)
+        pickle_save(stats.get_idf(), FILE_IDF)
+
+    # Binary model for NaiveBayesClassifier.load
+    classifier = stats.build_classifier(smooth_factor=SMOOTH_FACTOR)
+    classifier.save(FILE_MODEL)
 
 
-def gen_index_file(train_file, dev_file, k_fold, shuffle=True):
+def split_folds(lines: list, k_fold: int) -> list:
+    '''
+    Split `lines` into `k_fold` folds of equal size, the remaining
+    len(lines) % k_fold lines are in no fold (always in train set).
+    '''
+    sep = len(lines) // k_fold
+    return [lines[i * sep : (i + 1) * sep] for i in range(k_fold)]
+
+
+def gen_index_file(train_file, dev_file, k_fold, shuffle=True, fold=0):
     lines = []
     with open(FILE_INDEX_FULL) as f:
         lines = f.readlines()
     if shuffle:
         random.shuffle(lines)
-    sep = len(lines) // k_fold
-    train_lines = lines[sep:]
-    dev_lines = lines[:sep]
+    folds = split_folds(lines, k_fold)
+    dev_lines = folds[fold]
+    train_lines = [line for i, f in enumerate(folds) if i != fold for line in f]
+    train_lines += lines[k_fold * len(dev_lines):]
     for i in range(2):
         with open([train_file, dev_file][i], 'w') as f:
             for line in [train_lines, dev_lines][i]:
@@ -153,6 +485,43 @@ def parse_args():
         help='proportion of the dataset to be used',
         type=float,
         default=1.0)
+    parser.add_argument(
+        '--workers',
+        help='number of processes used to parse emails',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--stream',
+        help='parse training emails lazily instead of loading them into memory',
+        action='store_true')
+    parser.add_argument(
+        '--no_cache',
+        help='parse every email again instead of reading the parse cache',
+        action='store_true')
+    parser.add_argument(
+        '--min_df',
+        help='drop words in fewer training emails',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--max_vocab',
+        help='keep at most this many words, ranked by --rank_by',
+        type=int)
+    parser.add_argument(
+        '--rank_by',
+        help='ranking of words for --max_vocab',
+        choices=['count', 'info_gain'],
+        default='count')
+    parser.add_argument(
+        '--min_letter_ratio',
+        help='drop words where less than this proportion of chars are letters',
+        type=float,
+        default=0.0)
+    parser.add_argument(
+        '--hash_buckets',
+        help='count words in this many hash buckets instead of per word (no pruning)',
+        type=int,
+        default=HASH_BUCKETS)
     return parser.parse_args()
 
 
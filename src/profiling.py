@@ -0,0 +1,123 @@
+'''
+Opt-in instrumentation of the hot paths, enabled by an environment
+variable so that it works with every script:
+
+    NB_PROFILE=1 python3 preprocess.py          # summary of stages/counters
+    NB_PROFILE=cprofile python3 test.py         # + cProfile top functions
+    NB_PROFILE=cprofile NB_PROFILE_OUT=t.pstats python3 test.py
+
+The summary (cumulative time and # calls of each stage, counters such as
+tokens per email and parse cache hit rate) is printed to stderr at exit.
+When disabled, `timed` returns the function itself and `stage` a shared
+no-op context, so instrumented code runs as before.
+
+NOTE: only the main process is measured, use --workers 1 when profiling.
+'''
+import os
+import sys
+import time
+import atexit
+import contextlib
+from collections import defaultdict
+from functools import wraps
+
+
+MODE = os.environ.get('NB_PROFILE', '')
+ENABLED = MODE not in ('', '0')
+
+stage_secs = defaultdict(float)  # {stage: cumulative seconds}
+stage_calls = defaultdict(int)   # {stage: # calls}
+counters = defaultdict(int)      # {name: count}
+profiler = None
+
+NULL_STAGE = contextlib.nullcontext()
+
+
+class Stage:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        stage_secs[self.name] += time.perf_counter() - self.start
+        stage_calls[self.name] += 1
+
+
+def stage(name):
+    '''
+    with stage('name'): ... adds the time of the block to stage `name`
+    '''
+    return Stage(name) if ENABLED else NULL_STAGE
+
+
+def timed(name):
+    '''
+    Decorator adding the time of every call to stage `name`
+    '''
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stage_secs[name] += time.perf_counter() - start
+                stage_calls[name] += 1
+        return wrapper
+    return decorator
+
+
+def count(name, n=1) -> None:
+    '''
+    Callers on hot paths should check ENABLED first
+    '''
+    counters[name] += n
+
+
+def summary() -> str:
+    lines = [f'{"stage":40s} {"calls":>10} {"total s":>10} {"mean ms":>10}']
+    for name in sorted(stage_secs, key=stage_secs.get, reverse=True):
+        secs, calls = stage_secs[name], stage_calls[name]
+        lines.append(f'{name:40s} {calls:10d} {secs:10.3f} {1e3 * secs / calls:10.4f}')
+    if counters:
+        lines.append(f'{"counter":40s} {"count":>10}')
+        for name in sorted(counters):
+            lines.append(f'{name:40s} {counters[name]:10d}')
+    if counters['emails'] > 0:
+        lines.append(f'{"tokens per email":40s} {counters["tokens"] / counters["emails"]:10.1f}')
+    # Hit rate of every '<cache>.hit' / '<cache>.miss' pair
+    for name in sorted(counters):
+        if name.endswith('.hit'):
+            cache = name[:-len('.hit')]
+            total = counters[name] + counters[cache + '.miss']
+            lines.append(f'{cache + " hit rate":40s} {counters[name] / total:10.3f}')
+    return '\n'.join(lines)
+
+
+def dump() -> None:
+    print('--- Profile ---', file=sys.stderr)
+    print(summary(), file=sys.stderr)
+    if profiler is not None:
+        import pstats
+        profiler.disable()
+        out = os.environ.get('NB_PROFILE_OUT')
+        if out:
+            profiler.dump_stats(out)
+            print('cProfile stats written to', out, file=sys.stderr)
+        else:
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(30)
+
+
+if ENABLED:
+    if MODE == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    atexit.register(dump)
@@ -0,0 +1,123 @@
+'''
+Accuracy vs size of pruned models: counts the training emails once, then
+for every combination of the pruning parameters builds the pruned model
+and tests it on the dev dataset.
+
+    python3 prune_report.py --min_df 1 2 5 --max_vocab 0 20000 5000 1000
+'''
+import os
+import random
+import argparse
+import tempfile
+from itertools import product
+from config import *
+from utils import *
+from dataloader import DataLoader
+from parse_cache import ParseCache
+from preprocess import CorpusStats
+from corpus import load_dataset
+from test import add_model_args, model_params, test_classifier
+
+
+_file = '[' + os.path.basename(__file__) + ']'
+
+
+def model_size(classifier) -> int:
+    '''
+    Return # bytes of the saved model
+    '''
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, 'model.nbm')
+        classifier.save(filename)
+        return os.path.getsize(filename)
+
+
+def prune_report(args):
+    # Same shuffles as preprocess.py: dev index first, then train index
+    random.seed(SEED)
+    DataLoader(FILE_INDEX_DEV, stream=True)
+    cache = None if args.no_cache else ParseCache(FILE_PARSE_CACHE)
+    train_loader = DataLoader(
+        FILE_INDEX_TRAIN, args.data_size, workers=args.workers, stream=True, cache=cache)
+    stats = CorpusStats().update(train_loader)
+    dev_dataset = load_dataset(FILE_DEV_CORPUS, FILE_DEV_DATASET)
+
+    params = model_params(args)
+    grid = []
+    for min_df, ratio, max_vocab, rank_by in product(
+            args.min_df, args.min_letter_ratio, args.max_vocab, args.rank_by):
+        # rank_by only matters with a max vocab size
+        point = (min_df, ratio, max_vocab or None, rank_by if max_vocab else '-')
+        if point not in grid:
+            grid.append(point)
+
+    rows = []
+    for min_df, ratio, max_vocab, rank_by in grid:
+        pruned = stats.prune(min_df, max_vocab, rank_by, ratio)
+        classifier = pruned.build_classifier(**params)
+        scores = test_classifier(classifier, dev_dataset)
+        rows.append((min_df, ratio, max_vocab or '-', rank_by, len(pruned.vocab),
+                     model_size(classifier) / 2**20, scores))
+
+    print(f'{"min_df":>6} {"ratio":>5} {"max_vocab":>9} {"rank_by":>9} {"vocab":>8} {"MB":>7} '
+          f'{"accuracy":>9} {"macro_f1":>9} {"micro_f1":>9} {"recall":>9}')
+    for min_df, ratio, max_vocab, rank_by, vocab_size, mb, scores in rows:
+        print(f'{min_df:6d} {ratio:5g} {max_vocab:>9} {rank_by:>9} {vocab_size:8d} {mb:7.2f} '
+              f'{scores["acc"]*100:9.3f} {scores["macro_f1"]*100:9.3f} '
+              f'{scores["micro_f1"]*100:9.3f} {scores["recall"]*100:9.3f}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--min_df',
+        help='values of the min document frequency',
+        type=int,
+        nargs='+',
+        default=[1, 2, 5],
+    )
+    parser.add_argument(
+        '--max_vocab',
+        help='values of the max vocab size, 0 = no limit',
+        type=int,
+        nargs='+',
+        default=[0, 20000, 5000, 1000],
+    )
+    parser.add_argument(
+        '--rank_by',
+        help='rankings of words for --max_vocab',
+        choices=['count', 'info_gain'],
+        nargs='+',
+        default=['count', 'info_gain'],
+    )
+    parser.add_argument(
+        '--min_letter_ratio',
+        help='values of the min proportion of letters in a word',
+        type=float,
+        nargs='+',
+        default=[0.0, 0.5],
+    )
+    parser.add_argument(
+        '--data_size',
+        help='proportion of the dataset to be used',
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        '--workers',
+        help='number of processes used to parse emails',
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        '--no_cache',
+        help='parse every email again instead of reading the parse cache',
+        action='store_true',
+    )
+    add_model_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    prune_report(args)
@@ -0,0 +1,223 @@
+import hashlib
+import threading
+from itertools import chain
+from collections import OrderedDict
+import numpy as np
+
+
+def content_key(data: bytes) -> bytes:
+    '''
+    Exact key of a raw email
+    '''
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class ResultCache:
+    '''
+    Bounded LRU cache of the scores of `classifier` (see score_batch), so
+    that copies of the emails of a spam campaign are not scored again.
+
+    Entries are keyed by content_key of the raw email if known (exact
+    hits, which also skip parsing, see get), and indexed by a MinHash
+    signature of the set of words of the email: emails whose signatures
+    agree on all rows of one of `bands` bands are candidates (LSH), and a
+    candidate is a near-duplicate if the signatures agree on at least
+    `threshold` of their values, i.e. the estimated Jaccard similarity of
+    the word sets. A near-duplicate reuses the word scores of the cached
+    email and only its IP and hour are scored, so its label may differ
+    from full scoring if the word sets differ. A near-duplicate is then
+    cached under its own key too, so that its copies are exact hits.
+    Words are hashed with hash(), signatures are only comparable within a
+    process. With `threshold` None there are no signatures, only exact
+    hits: signatures cost about as much as scoring with a small model.
+
+    The cache is cleared when the model changes: counts or smoothing
+    (classifier.version), number of features, use_ip/use_time or weights.
+    Safe to use from several threads.
+    '''
+    def __init__(self, classifier, capacity=10000, threshold=0.9, num_perm=64, bands=16, seed=0):
+        assert num_perm % bands == 0
+        self.classifier = classifier
+        self.capacity = capacity
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        # MinHash functions h(x) = (mul * x + add) >> 32 (mod 2^64), mul odd
+        rng = np.random.default_rng(seed)
+        self.mul = rng.integers(0, 2**63, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.add = rng.integers(0, 2**63, num_perm, dtype=np.uint64)
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # {id: (signature, word scores, scores)}, oldest first
+        self.buckets = [{} for _ in range(bands)]  # [{band of signature: {id}}]
+        self.by_signature = {}  # {signature: id}, for identical word sets
+        self.model_state = None
+
+        # Stats
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def signatures(self, emails: list) -> np.ndarray:
+        '''
+        Return MinHash signatures of the words of `emails`, shape
+        (# emails, num_perm)
+        '''
+        lens = np.fromiter((len(email['words']) for email in emails), dtype=np.int64, count=len(emails))
+        x = np.fromiter(chain.from_iterable(map(hash, email['words']) for email in emails),
+                        dtype=np.int64, count=int(lens.sum())).view(np.uint64)
+        h = (x[:, None] * self.mul + self.add) >> np.uint64(32)
+        signatures = np.full((len(emails), self.num_perm), 2**32 - 1, dtype=np.uint64)
+        # Emails without words keep the max, reduceat skips their empty ranges
+        nonempty = lens > 0
+        signatures[nonempty] = np.minimum.reduceat(h, (np.cumsum(lens) - lens)[nonempty], axis=0)
+        return signatures.astype(np.uint32)
+
+    def band_keys(self, signature: np.ndarray) -> list:
+        return [band.tobytes() for band in signature.reshape(self.bands, -1)]
+
+    def check_model(self) -> None:
+        c = self.classifier
+        state = (c.version, c.num_features, c.use_ip, c.use_time, c.ip_weight, c.time_weight)
+        if state != self.model_state:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.buckets = [{} for _ in range(self.bands)]
+            self.by_signature.clear()
+            self.model_state = state
+
+    def get(self, key: bytes):
+        '''
+        Return the cached scores of the email with content_key `key`, None
+        if not cached (not counted as a miss, see score_batch)
+        '''
+        with self.lock:
+            self.check_model()
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def lookup(self, key, signature: np.ndarray) -> tuple:
+        '''
+        Return (exact, entry) of the email, entry None if not cached
+        '''
+        if key is not None and key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, self.entries[key]
+        if signature is None:
+            self.misses += 1
+            return False, None
+        best = self.by_signature.get(signature.tobytes())
+        if best is None:
+            candidates = set()
+            for bucket, band in zip(self.buckets, self.band_keys(signature)):
+                candidates.update(bucket.get(band, ()))
+            if candidates:
+                candidates = list(candidates)
+                sims = (np.array([self.entries[entry_id][0] for entry_id in candidates])
+                        == signature).mean(axis=1)
+                if sims.max() >= self.threshold:
+                    best = candidates[int(sims.argmax())]
+        if best is None:
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(best)
+        self.near_hits += 1
+        return False, self.entries[best]
+
+    def put(self, key, signature: np.ndarray, word_scores: np.ndarray, scores: np.ndarray) -> None:
+        # Emails without key are cached by signature only
+        if key is None and signature is None:
+            return
+        entry_id = key if key is not None else ('signature', signature.tobytes())
+        if entry_id in self.entries:
+            self.remove(entry_id)
+        self.entries[entry_id] = (signature, word_scores, scores)
+        if signature is not None:
+            for bucket, band in zip(self.buckets, self.band_keys(signature)):
+                bucket.setdefault(band, set()).add(entry_id)
+            self.by_signature[signature.tobytes()] = entry_id
+        while len(self.entries) > self.capacity:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, entry_id) -> None:
+        signature = self.entries.pop(entry_id)[0]
+        if signature is None:
+            return
+        for bucket, band in zip(self.buckets, self.band_keys(signature)):
+            ids = bucket[band]
+            ids.discard(entry_id)
+            if not ids:
+                del bucket[band]
+        # Another entry with the same signature may have replaced it
+        if self.by_signature.get(signature.tobytes()) == entry_id:
+            del self.by_signature[signature.tobytes()]
+
+    def score_batch(self, emails: list, keys=None) -> np.ndarray:
+        '''
+        Same as classifier.score_batch, except that the scores of emails
+        in the cache and of near-duplicates come from the cache. The other
+        emails are scored in one batch and cached.
+        `keys`: content_key of each email, None if unknown
+        '''
+        classifier = self.classifier
+        if not classifier.pre_computed:
+            classifier.pre_compute()
+        if keys is None:
+            keys = [None] * len(emails)
+
+        if self.threshold is None:
+            signatures = [None] * len(emails)
+        else:
+            signatures = self.signatures(emails)
+        scores = np.empty((len(emails), len(classifier.labels)))
+        near, near_word_scores, missed = [], [], []
+        with self.lock:
+            self.check_model()
+            for i, (key, signature) in enumerate(zip(keys, signatures)):
+                exact, entry = self.lookup(key, signature)
+                if entry is None:
+                    missed.append(i)
+                elif exact:
+                    scores[i] = entry[2]
+                else:
+                    near.append(i)
+                    near_word_scores.append(entry[1])
+
+        if near:
+            side_scores = classifier.side_scores([emails[i] for i in near])
+            scores[near] = classifier.combine_scores(np.array(near_word_scores), *side_scores)
+            with self.lock:
+                self.check_model()
+                for i, word_row in zip(near, near_word_scores):
+                    if keys[i] is not None:
+                        self.put(keys[i], signatures[i], word_row, scores[i].copy())
+        if missed:
+            missed_emails = [emails[i] for i in missed]
+            x = classifier.select_features_batch(missed_emails)
+            word_scores, ip_scores, time_scores = classifier.score_components(x, missed_emails)
+            scores[missed] = classifier.combine_scores(word_scores, ip_scores, time_scores)
+            with self.lock:
+                self.check_model()
+                for i, word_row in zip(missed, word_scores):
+                    self.put(keys[i], signatures[i], word_row.copy(), scores[i].copy())
+        return scores
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'near_hits': self.near_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
@@ -0,0 +1,267 @@
+'''
+Classification daemon: loads the model once and classifies raw (RFC822)
+emails sent over HTTP, on a TCP port or a Unix socket.
+
+    POST /classify    body: raw email
+        -> {"label": 1, "log_odds": 12.3, "latency_ms": 0.8, "queue_depth": 2}
+    GET /stats
+        -> # requests, latency percentiles, queue depth, mean batch size,
+           result cache hits/misses/evictions
+
+Concurrent requests are micro-batched: the batcher waits up to
+--max_delay ms after the first queued email (or until --max_batch emails
+are queued) and scores the batch with one classify_batch-style call.
+Exact copies of recent emails (spam campaigns) are scored from a
+ResultCache of --cache_size emails without being parsed, and with
+--cache_threshold so are near-duplicates (after parsing).
+
+    python3 server.py --port 8080
+    curl --data-binary @../data/trec06p/data/000/000 localhost:8080/classify
+'''
+import os
+import time
+import json
+import asyncio
+import argparse
+import numpy as np
+from collections import deque
+from config import *
+from dataloader import parse_bytes
+from result_cache import ResultCache, content_key
+from test import add_model_args, load_classifier
+
+
+_file = '[' + os.path.basename(__file__) + ']'
+
+
+class BatchScorer:
+    '''
+    Queue of parsed emails waiting to be scored, scored in batches by
+    run() (one batch at a time, in a worker thread so that the event loop
+    keeps accepting requests meanwhile). Emails are also parsed in worker
+    threads.
+    '''
+    def __init__(self, classifier, max_batch=64, max_delay=0.002, history=10000, cache=None):
+        self.classifier = classifier
+        self.cache = cache
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.spam = classifier.label_index[1]
+        self.ham = classifier.label_index[0]
+        # Stats
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_batched = 0  # emails scored in batches
+        self.latencies = deque(maxlen=history)  # seconds, of the last requests
+
+    async def classify(self, data: bytes) -> dict:
+        start = time.perf_counter()
+        key = None
+        scores = None
+        queue_depth = self.queue.qsize()
+        if self.cache is not None:
+            key = content_key(data)
+            scores = self.cache.get(key)
+        if scores is None:
+            loop = asyncio.get_running_loop()
+            email = await loop.run_in_executor(None, parse_bytes, data)
+            future = loop.create_future()
+            await self.queue.put((email, key, future))
+            scores = await future
+        latency = time.perf_counter() - start
+        self.num_requests += 1
+        self.latencies.append(latency)
+        return {
+            'label': self.classifier.labels[int(scores.argmax())],
+            'log_odds': float(scores[self.spam] - scores[self.ham]),
+            'latency_ms': latency * 1e3,
+            'queue_depth': queue_depth,
+        }
+
+    async def next_batch(self) -> list:
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            emails = [email for email, _, _ in batch]
+            try:
+                if self.cache is not None:
+                    keys = [key for _, key, _ in batch]
+                    scores = await loop.run_in_executor(None, self.cache.score_batch, emails, keys)
+                else:
+                    scores = await loop.run_in_executor(None, self.classifier.score_batch, emails)
+            except Exception as e:
+                for _, _, future in batch:
+                    # Cancelled if the client went away
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.num_batches += 1
+            self.num_batched += len(batch)
+            for (_, _, future), row in zip(batch, scores):
+                if not future.done():
+                    future.set_result(row)
+
+    def stats(self) -> dict:
+        latencies = np.array(self.latencies) * 1e3
+        stats = {
+            'num_requests': self.num_requests,
+            'num_batches': self.num_batches,
+            'mean_batch_size': self.num_batched / max(1, self.num_batches),
+            'queue_depth': self.queue.qsize(),
+        }
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        if len(latencies) > 0:
+            for p in (50, 90, 99):
+                stats[f'latency_ms_p{p}'] = float(np.percentile(latencies, p))
+        return stats
+
+
+async def read_request(reader) -> tuple:
+    '''
+    Return (method, path, headers, body) of the next HTTP request, None if
+    the connection was closed
+    '''
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, headers, body
+
+
+def write_response(writer, status: str, result: dict, keep_alive: bool) -> None:
+    body = json.dumps(result).encode('utf8')
+    head = (f'HTTP/1.1 {status}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+    writer.write(head.encode('latin-1') + body)
+
+
+def make_handler(scorer: BatchScorer):
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if method == 'POST' and path == '/classify':
+                    try:
+                        result = await scorer.classify(body)
+                    except Exception as e:
+                        # A bug or a model error must not drop the
+                        # connection, the client gets a 500 and the
+                        # server goes on
+                        print(_file, 'Error classifying an email:', repr(e))
+                        write_response(writer, '500 Internal Server Error',
+                                       {'error': repr(e)}, keep_alive)
+                    else:
+                        write_response(writer, '200 OK', result, keep_alive)
+                elif method == 'GET' and path == '/stats':
+                    write_response(writer, '200 OK', scorer.stats(), keep_alive)
+                else:
+                    write_response(writer, '404 Not Found', {'error': f'{method} {path}'}, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError) as e:
+            print(_file, 'Bad request:', repr(e))
+        finally:
+            writer.close()
+    return handle
+
+
+async def serve(args) -> None:
+    print(_file, 'Loading model...')
+    classifier = load_classifier(args)
+    classifier.pre_compute()
+    cache = None
+    if args.cache_size > 0:
+        cache = ResultCache(classifier, args.cache_size, args.cache_threshold)
+    scorer = BatchScorer(classifier, args.max_batch, args.max_delay / 1e3, cache=cache)
+    handler = make_handler(scorer)
+    if args.socket:
+        server = await asyncio.start_unix_server(handler, args.socket)
+        print(_file, 'Listening on', args.socket)
+    else:
+        server = await asyncio.start_server(handler, args.host, args.port)
+        print(_file, f'Listening on {args.host}:{args.port}')
+    batcher = asyncio.create_task(scorer.run())
+    async with server:
+        await server.serve_forever()
+    batcher.cancel()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8080,
+    )
+    parser.add_argument(
+        '--socket',
+        help='Unix socket to listen on instead of host:port',
+    )
+    parser.add_argument(
+        '--max_batch',
+        help='Max # emails scored at once',
+        type=int,
+        default=64,
+    )
+    parser.add_argument(
+        '--max_delay',
+        help='Max time (ms) an email waits for others to be batched with',
+        type=float,
+        default=2.0,
+    )
+    parser.add_argument(
+        '--cache_size',
+        help='Max # emails in the result cache, 0 = no cache',
+        type=int,
+        default=10000,
+    )
+    parser.add_argument(
+        '--cache_threshold',
+        help='Also score near-duplicates from the cache: min estimated Jaccard similarity'
+             ' of their words, e.g. 0.9',
+        type=float,
+    )
+    add_model_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,216 @@
+'''
+Sharded training: each mapper counts the emails of one shard of the
+training index and saves the counts to a partial count file, the count
+files are then merged into the pre-processed data and model of
+preprocess.py.
+
+    # On machine i of 4, with the emails and the index files
+    python3 shard_train.py map --shard i --num_shards 4
+    # On one machine, with the count files copied to it
+    python3 shard_train.py reduce ../data/processed/shard_counts/*.npz
+    # Or everything on this machine, 4 mappers as subprocesses
+    python3 shard_train.py run --num_shards 4
+
+Shards are contiguous parts of the training emails in the order that
+preprocess.py counts them, and count files are merged in shard order, so
+words keep the order of their first occurrence: the result is the same as
+preprocess.py with the same --data_size and pruning parameters. Count
+files of consecutive shards can also be merged into one (reduce --out)
+to be merged again later.
+
+reduce does not process the dev dataset, run does (as preprocess.py). Neither
+saves the train corpus, as preprocess.py --stream.
+'''
+import os
+import sys
+import random
+import argparse
+import subprocess
+from config import *
+from utils import *
+from dataloader import DataLoader
+from parse_cache import ParseCache
+from preprocess import CorpusStats, process_dev, save_processed
+
+
+_file = '[' + os.path.basename(__file__) + ']'
+
+
+def count_file(shard: int, num_shards: int) -> str:
+    return os.path.join(DIR_SHARD_COUNTS, f'counts_{shard}_of_{num_shards}.npz')
+
+
+def shard_cache_file(shard: int, num_shards: int) -> str:
+    '''
+    Parse cache of a shard, so that concurrent mappers never append to the
+    same file
+    '''
+    root, ext = os.path.splitext(FILE_PARSE_CACHE)
+    return f'{root}_{shard}_of_{num_shards}{ext}'
+
+
+def count_shard(args) -> None:
+    '''
+    Count the emails of shard args.shard and save them to a count file
+    '''
+    # Same shuffles as preprocess.py: dev index first, then train index
+    random.seed(SEED)
+    DataLoader(FILE_INDEX_DEV, stream=True)
+    cache = None if args.no_cache else ParseCache(shard_cache_file(args.shard, args.num_shards))
+    loader = DataLoader(
+        FILE_INDEX_TRAIN, args.data_size, workers=args.workers, stream=True, cache=cache,
+        shard=(args.shard, args.num_shards))
+    print(_file, f'Shard {args.shard} of {args.num_shards}: {len(loader)} examples')
+    stats = CorpusStats(args.hash_buckets).update(loader)
+
+    filename = args.out or count_file(args.shard, args.num_shards)
+    if os.path.dirname(filename) and not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    meta = {
+        'shards': [args.shard, args.shard + 1],
+        'num_shards': args.num_shards,
+        'data_size': args.data_size,
+    }
+    stats.save(filename, meta)
+    print(_file, 'Saved counts to', filename)
+
+
+def merge_counts(filenames: list) -> tuple:
+    '''
+    Merge count files of consecutive shards, in shard order whatever the
+    order of `filenames`.
+    Return: (stats, meta), meta['shards'] = [first shard, last shard + 1]
+    '''
+    parts = sorted((CorpusStats.load(filename) for filename in filenames),
+                   key=lambda part: part[1]['shards'][0])
+    stats, meta = parts[0]
+    for other, other_meta in parts[1:]:
+        for key in ('num_shards', 'data_size'):
+            if other_meta[key] != meta[key]:
+                raise ValueError(f'Count files with different {key}: {meta[key]}, {other_meta[key]}')
+        if other.hash_buckets != stats.hash_buckets:
+            raise ValueError('Count files with different hash_buckets')
+        if other_meta['shards'][0] != meta['shards'][1]:
+            raise ValueError(f'Shards {other_meta["shards"]} do not follow shards {meta["shards"]}'
+                             ', shards are missing or duplicated')
+        stats.merge(other)
+        meta = dict(meta, shards=[meta['shards'][0], other_meta['shards'][1]])
+    return stats, meta
+
+
+def reduce(args) -> None:
+    stats, meta = merge_counts(args.files)
+    print(_file, f'Merged shards {meta["shards"][0]} to {meta["shards"][1] - 1}'
+                 f' of {meta["num_shards"]}: {stats.num_docs} examples')
+    if args.out:
+        stats.save(args.out, meta)
+        print(_file, 'Saved counts to', args.out)
+        return
+    if meta['shards'] != [0, meta['num_shards']]:
+        raise ValueError(f'Shards {meta["shards"]} of {meta["num_shards"]} are not all the shards,'
+                         ' use --out to merge them into a count file')
+    save_processed(stats, args)
+
+
+def run(args) -> None:
+    '''
+    Run a mapper for each shard as a subprocess, then reduce
+    '''
+    cmd = [sys.executable, os.path.abspath(__file__), 'map',
+           '--num_shards', str(args.num_shards),
+           '--data_size', str(args.data_size),
+           '--workers', str(args.workers)]
+    if args.no_cache:
+        cmd.append('--no_cache')
+    if args.hash_buckets:
+        cmd += ['--hash_buckets', str(args.hash_buckets)]
+    procs = [subprocess.Popen(cmd + ['--shard', str(shard)]) for shard in range(args.num_shards)]
+    failed = [shard for shard, proc in enumerate(procs) if proc.wait() != 0]
+    if failed:
+        raise RuntimeError(f'Mappers of shards {failed} failed')
+
+    cache = None if args.no_cache else ParseCache(FILE_PARSE_CACHE)
+    process_dev(args.workers, cache)
+    args.files = [count_file(shard, args.num_shards) for shard in range(args.num_shards)]
+    args.out = None
+    reduce(args)
+
+
+def parse_args():
+    count_parser = argparse.ArgumentParser(add_help=False)
+    count_parser.add_argument(
+        '--num_shards',
+        help='number of shards of the training index',
+        type=int,
+        required=True)
+    count_parser.add_argument(
+        '--data_size',
+        help='proportion of the dataset to be used',
+        type=float,
+        default=1.0)
+    count_parser.add_argument(
+        '--workers',
+        help='number of processes used to parse emails, by each mapper',
+        type=int,
+        default=1)
+    count_parser.add_argument(
+        '--no_cache',
+        help='parse every email again instead of reading the parse cache',
+        action='store_true')
+    count_parser.add_argument(
+        '--hash_buckets',
+        help='count words in this many hash buckets instead of per word (no pruning)',
+        type=int,
+        default=HASH_BUCKETS)
+
+    # As preprocess.py
+    prune_parser = argparse.ArgumentParser(add_help=False)
+    prune_parser.add_argument(
+        '--min_df',
+        help='drop words in fewer training emails',
+        type=int,
+        default=1)
+    prune_parser.add_argument(
+        '--max_vocab',
+        help='keep at most this many words, ranked by --rank_by',
+        type=int)
+    prune_parser.add_argument(
+        '--rank_by',
+        help='ranking of words for --max_vocab',
+        choices=['count', 'info_gain'],
+        default='count')
+    prune_parser.add_argument(
+        '--min_letter_ratio',
+        help='drop words where less than this proportion of chars are letters',
+        type=float,
+        default=0.0)
+
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    map_parser = commands.add_parser(
+        'map', parents=[count_parser], help='count the emails of one shard')
+    map_parser.add_argument(
+        '--shard',
+        help='index of the shard, from 0',
+        type=int,
+        required=True)
+    map_parser.add_argument(
+        '--out',
+        help='count file, default in ' + DIR_SHARD_COUNTS)
+    reduce_parser = commands.add_parser(
+        'reduce', parents=[prune_parser], help='merge count files')
+    reduce_parser.add_argument(
+        'files',
+        help='count files of the shards',
+        nargs='+')
+    reduce_parser.add_argument(
+        '--out',
+        help='save the merged counts to this count file instead of the pre-processed data')
+    commands.add_parser(
+        'run', parents=[count_parser, prune_parser], help='map all shards on this machine, then reduce')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    {'map': count_shard, 'reduce': reduce, 'run': run}[args.command](args)
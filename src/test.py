@@ -1,9 +1,14 @@
 import os
+import time
 import random
 import argparse
+import numpy as np
+from multiprocessing import Pool
 from tqdm import tqdm
 from config import *
 from classifier import NaiveBayesClassifier
+from ip_index import IP_BACKOFF
+from corpus import column, load_dataset
 from utils import *
 from sklearn.metrics import f1_score, accuracy_score, precision_score, recall_score
 
@@ -46,51 +51,208 @@ def get_processed_data() -> tuple:
         idf)
 
 
-def test_classifier(classifier, dataset):
-    gold = [e['label'] for e in dataset]
+def test_classifier(classifier, dataset, batch_size=1024):
+    gold = column(dataset, 'label')
     predict = []
-    for email in tqdm(dataset):
-        output = classifier.classify(email)
-        predict.append(output)
+    for i in tqdm(range(0, len(dataset), batch_size)):
+        predict += classifier.classify_batch(dataset[i : i + batch_size])
 
     scores = calc_score(gold, predict)
     return scores
 
 
+def add_model_args(parser) -> None:
+    '''
+    Add the arguments of model_params to `parser`
+    '''
+    parser.add_argument(
+        '--smooth',
+        help='Laplace smoothing factor',
+        type=float,
+        default=SMOOTH_FACTOR,
+    )
+    parser.add_argument(
+        '--use_ip',
+        help='Whether to use IP address for classification',
+        action=argparse.BooleanOptionalAction,
+        default=True,
+    )
+    parser.add_argument(
+        '--use_time',
+        help='Whether to use time for classification',
+        action=argparse.BooleanOptionalAction,
+        default=True,
+    )
+    parser.add_argument(
+        '--time_weight',
+        help='Weight of time',
+        type=float,
+        default=2,
+    )
+    parser.add_argument(
+        '--ip_weight',
+        help='Weight of IP address',
+        type=float,
+        default=1,
+    )
+    parser.add_argument(
+        '--ip_backoff',
+        help='Weights of the IP estimates of /32, /24 and /16',
+        type=float,
+        nargs=3,
+        default=IP_BACKOFF,
+    )
+
+
+def model_params(args) -> dict:
+    '''
+    Keyword arguments of NaiveBayesClassifier from the args of add_model_args
+    '''
+    return dict(
+        smooth_factor=args.smooth,
+        use_time=args.use_time,
+        use_ip=args.use_ip,
+        time_weight=args.time_weight,
+        ip_weight=args.ip_weight,
+        ip_backoff=args.ip_backoff,
+        )
+
+
+def load_classifier(args):
+    params = model_params(args)
+    if os.path.exists(FILE_MODEL):
+        return NaiveBayesClassifier.load(FILE_MODEL, **params)
+    # Processed by an older preprocess.py, without the model file
+    processed_data = get_processed_data()
+    return NaiveBayesClassifier(*processed_data[1:], **params)
+
+
+def parse_sweep(items: list, args) -> dict:
+    '''
+    ['smooth=0.1,1', 'ip_weight=0,1'] -> {'smooth': [0.1, 1.0], 'ip_weight':
+    [0.0, 1.0], 'time_weight': [args.time_weight]}
+    '''
+    grid = {
+        'smooth': [args.smooth],
+        'ip_weight': [args.ip_weight],
+        'time_weight': [args.time_weight],
+    }
+    for item in items:
+        name, _, values = item.partition('=')
+        if name not in grid:
+            raise ValueError(f'Unknown sweep parameter {name}, should be one of {list(grid)}')
+        grid[name] = [float(v) for v in values.split(',')]
+    return grid
+
+
+# State of each process of the sweep, set by init_sweep
+sweep_state = {}
+
+
+def init_sweep(classifier, x, dataset):
+    sweep_state['classifier'] = classifier
+    sweep_state['x'] = x
+    sweep_state['dataset'] = dataset
+
+
+def sweep_smooth(smooth, ip_weights, time_weights):
+    '''
+    Return index of predicted label of each email for every weight pair,
+    array of shape (# ip weights, # time weights, # emails)
+    '''
+    classifier = sweep_state['classifier']
+    classifier.set_smooth_factor(smooth)
+    word_scores, ip_scores, time_scores = classifier.score_components(
+        sweep_state['x'], sweep_state['dataset'])
+    # IP and time scores are additive, combine them for all pairs at once
+    ip_weights = np.array(ip_weights)[:, None, None, None]
+    time_weights = np.array(time_weights)[None, :, None, None]
+    scores = word_scores + ip_weights * ip_scores + time_weights * time_scores
+    return scores.argmax(axis=-1)
+
+
+def sweep(args):
+    '''
+    Tests classifier on dev dataset for every point of the grid given by
+    args.sweep, loading data and selecting features only once.
+    '''
+    grid = parse_sweep(args.sweep, args)
+    print('Loading data...')
+    dev_dataset = load_dataset(FILE_DEV_CORPUS, FILE_DEV_DATASET)
+    classifier = load_classifier(args)
+    classifier.pre_compute()
+    # Feature selection does not depend on smoothing or weights
+    x = classifier.select_features_batch(dev_dataset)
+
+    ip_weights = grid['ip_weight'] if args.use_ip else [0.0]
+    time_weights = grid['time_weight'] if args.use_time else [0.0]
+    tasks = [(smooth, ip_weights, time_weights) for smooth in grid['smooth']]
+    print(f'Sweeping {len(tasks) * len(ip_weights) * len(time_weights)} grid points...')
+    if args.workers > 1 and len(tasks) > 1:
+        with Pool(args.workers, init_sweep, (classifier, x, dev_dataset)) as pool:
+            predicts = pool.starmap(sweep_smooth, tasks)
+    else:
+        init_sweep(classifier, x, dev_dataset)
+        predicts = [sweep_smooth(*task) for task in tasks]
+
+    gold = column(dev_dataset, 'label')
+    print(f'{"smooth":>10} {"ip_weight":>10} {"time_weight":>11} '
+          f'{"accuracy":>9} {"macro_f1":>9} {"micro_f1":>9} {"recall":>9}')
+    for smooth, predict in zip(grid['smooth'], predicts):
+        for i, ip_weight in enumerate(ip_weights):
+            for j, time_weight in enumerate(time_weights):
+                scores = calc_score(gold, [classifier.labels[k] for k in predict[i, j]])
+                print(f'{smooth:10g} {ip_weight:10g} {time_weight:11g} '
+                      f'{scores["acc"]*100:9.3f} {scores["macro_f1"]*100:9.3f} '
+                      f'{scores["micro_f1"]*100:9.3f} {scores["recall"]*100:9.3f}')
+
+
+def test_early_exit(args):
+    '''
+    Compares classify_early_exit with full scoring on the dev dataset:
+    labels must be the same, prints # words evaluated and latency
+    '''
+    print('Loading data...')
+    dev_dataset = load_dataset(FILE_DEV_CORPUS, FILE_DEV_DATASET)
+    classifier = load_classifier(args)
+    classifier.pre_compute()
+    emails = list(dev_dataset)
+
+    start = time.perf_counter()
+    full = [classifier.classify(email) for email in emails]
+    full_secs = time.perf_counter() - start
+    start = time.perf_counter()
+    results = [classifier.classify_early_exit(email) for email in emails]
+    early_secs = time.perf_counter() - start
+
+    num_diff = sum(label != f for (label, _), f in zip(results, full))
+    evaluated = np.array([n for _, n in results])
+    selected = np.array([min(len(e['words']), classifier.num_features) for e in emails])
+    print(f'--- Early exit ---')
+    print(f'# examples: {len(emails)}, # labels different from classify: {num_diff}')
+    print(f'words evaluated: mean {evaluated.mean():.1f} / {selected.mean():.1f} selected, '
+          f'p50 {np.percentile(evaluated, 50):.0f}, p90 {np.percentile(evaluated, 90):.0f}')
+    print(f'exited early: {(evaluated < selected).mean()*100:.1f}% of emails')
+    print(f'classify:            {1e6 * full_secs / len(emails):.1f} us/email')
+    print(f'classify_early_exit: {1e6 * early_secs / len(emails):.1f} us/email')
+
+
 def test(args):
     '''
     Tests classifier using dev dataset
     '''
     print('Loading data...')
-    processed_data = get_processed_data()
-    dev_dataset = processed_data[0]
-    label_cnts = processed_data[1]
-    global_word_cnts = processed_data[2]
-    label_word_cnts = processed_data[3]
-    label_ip_cnts = processed_data[4]
-    label_time_cnts = processed_data[5]
-    idf = processed_data[6]
+    dev_dataset = load_dataset(FILE_DEV_CORPUS, FILE_DEV_DATASET)
 
     print('Initializing classifier with parameters:')
     print('    Smoothing factor:', args.smooth)
     print('    Use IP:', args.use_ip)
     print('    Use time:', args.use_time)
     print('    IP weight:', args.ip_weight)
+    print('    IP back-off:', args.ip_backoff)
     print('    Time weight:', args.time_weight)
     
-    classifier = NaiveBayesClassifier(
-        label_cnts, 
-        global_word_cnts, 
-        label_word_cnts,
-        label_ip_cnts,
-        label_time_cnts,
-        idf,
-        smooth_factor=args.smooth,
-        use_time=args.use_time,
-        use_ip=args.use_ip,
-        time_weight=args.time_weight,
-        ip_weight=args.ip_weight,
-        )
+    classifier = load_classifier(args)
     print(f'--- Testing ---')
     print(f'# examples: {len(dev_dataset)}')
     print(f'---------------')
@@ -118,39 +280,31 @@ def test(args):
 
 def parse_args():
     parser = argparse.ArgumentParser()
+    add_model_args(parser)
     parser.add_argument(
-        '--smooth',
-        help='Laplace smoothing factor',
-        type=float,
-        default=1e-16,
+        '--sweep',
+        help='Test every combination of values, e.g. smooth=0.1,1 ip_weight=0,1 time_weight=1,2',
+        nargs='+',
     )
     parser.add_argument(
-        '--use_ip',
-        help='Whether to use IP address for classification',
-        action='store_true',
-        default=True,
+        '--workers',
+        help='Number of processes for --sweep',
+        type=int,
+        default=1,
     )
     parser.add_argument(
-        '--use_time',
-        help='Whether to use time for classification',
+        '--early_exit',
+        help='Compare early-exit scoring with full scoring',
         action='store_true',
-        default=True,
-    )    
-    parser.add_argument(
-        '--time_weight',
-        help='Weight of time',
-        type=float,
-        default=2,
-    )  
-    parser.add_argument(
-        '--ip_weight',
-        help='Weight of IP addres',
-        type=float,
-        default=1,
     )
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = parse_args()
-    test(args) 
\ No newline at end of file
+    if args.sweep:
+        sweep(args)
+    elif args.early_exit:
+        test_early_exit(args)
+    else:
+        test(args) 
\ No newline at end of file
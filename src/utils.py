@@ -8,12 +8,31 @@ def incr(d: dict, key, val=1):
         d[key] += val
 
 
+def update_cnt(d: dict, key, val):
+    '''
+    Add `val` to the count of `key`, keys whose count drops to 0 are
+    removed
+    '''
+    incr(d, key, val)
+    if d[key] == 0:
+        del d[key]
+
+
 def get_or(key, d: dict, default_val):
     if key in d:
         return d[key]
     return default_val
 
 
+def items_of(cnts):
+    '''
+    Return (key, cnt) pairs of a dict, or of a list of (key, cnt)
+    '''
+    if isinstance(cnts, dict):
+        return cnts.items()
+    return cnts
+
+
 def list_to_occ_dict(lis) -> dict:
     d = {}
     for x in lis:
@@ -21,6 +40,13 @@ def list_to_occ_dict(lis) -> dict:
     return d
 
 
+def align(n: int, alignment: int) -> int:
+    '''
+    Round `n` up to a multiple of `alignment`
+    '''
+    return (n + alignment - 1) // alignment * alignment
+
+
 def cnt_chars(s):
     cnt = 0
     for c in s:
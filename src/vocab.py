@@ -0,0 +1,289 @@
+import zlib
+import numpy as np
+from itertools import repeat
+
+
+class Vocabulary:
+    '''
+    Maps each word to an integer id, so that counts, IDF etc. can be kept
+    in arrays indexed by id instead of string-keyed dicts.
+    Ids are given in order of insertion, new words get the next id, so
+    arrays indexed by id only ever grow at the end.
+    '''
+    def __init__(self, words=()):
+        self.word_to_id = {}  # {word: id}
+        self.words = []       # [word], indexed by id
+        for word in words:
+            self.add(word)
+
+    def add(self, word) -> int:
+        '''
+        Return id of `word`, adding it to the vocab if it is new
+        '''
+        i = self.word_to_id.get(word)
+        if i is None:
+            i = len(self.words)
+            self.word_to_id[word] = i
+            self.words.append(word)
+        return i
+
+    def get(self, word, default=-1) -> int:
+        return self.word_to_id.get(word, default)
+
+    def lookup(self, words, default=-1) -> np.ndarray:
+        '''
+        Return array of ids of `words` (any iterable), `default` for
+        words not in vocab.
+        '''
+        return np.fromiter(
+            map(self.word_to_id.get, words, repeat(default)),
+            dtype=np.int64)
+
+    def __getitem__(self, word) -> int:
+        return self.word_to_id[word]
+
+    def __contains__(self, word) -> bool:
+        return word in self.word_to_id
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def to_bytes(self) -> bytes:
+        '''
+        Words in order of id, one per line (words never contain whitespace)
+        '''
+        return '\n'.join(self.words).encode('utf8')
+
+    def to_arrays(self) -> dict:
+        '''
+        Arrays of the MappedVocabulary of these words, saved by
+        NaiveBayesClassifier.save
+        '''
+        return MappedVocabulary.from_words(self.words).to_arrays()
+
+    @classmethod
+    def from_bytes(cls, blob):
+        vocab = cls()
+        if len(blob) > 0:
+            vocab.words = bytes(blob).decode('utf8').split('\n')
+            vocab.word_to_id = dict(zip(vocab.words, range(len(vocab.words))))
+        return vocab
+
+
+class MappedVocabulary:
+    '''
+    Read-only Vocabulary kept in 3 arrays instead of a dict, so that it
+    can be memory-mapped (see NaiveBayesClassifier.load): loading it costs
+    nothing whatever the vocab size, and processes loading the same file
+    share its pages.
+    - blob: the words in order of id, one per line (as to_bytes)
+    - offsets: (vocab size + 1,), start of each word in blob, the last
+      one is len(blob) + 1
+    - table: open-addressing hash table, a power of 2 of slots holding
+      word ids (-1 if empty), a word is in the first slot from
+      crc32(word) % len(table) on that is empty or holds it
+    A batch of words is looked up at once with numpy (find), probing the
+    slots of all the words and comparing their bytes to those of the
+    words in the slots, the few words left after some slots are probed
+    one at a time. The ids of the words looked up are kept in a dict
+    (self.cache) of at most CACHE_SIZE words, frequent words then cost a
+    dict access as with Vocabulary. add() is not supported, see
+    to_vocabulary.
+    '''
+    # Words left when find() probes them one at a time
+    PROBE_ONE_BELOW = 64
+    # Max # words in self.cache, it is emptied when full
+    CACHE_SIZE = 1 << 18
+
+    def __init__(self, blob, offsets, table):
+        self.blob = blob
+        self.offsets = offsets
+        self.table = table
+        self.mask = len(table) - 1
+        # Indexing memoryviews gives Python ints and bytes, faster than
+        # numpy scalars when probing one word at a time
+        self.blob_view = memoryview(blob)
+        self.offsets_view = memoryview(offsets)
+        self.table_view = memoryview(table)
+        self.cache = {}  # {word: id or -1}
+
+    @classmethod
+    def from_words(cls, words):
+        words = [word.encode('utf8') for word in words]
+        lens = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+        offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum(lens + 1, out=offsets[1:])
+        # At most a quarter full, so that probing stops after a few slots
+        size = 1 << max(4 * len(words) - 1, 1).bit_length()
+        table = np.full(size, -1, dtype=np.int32 if len(words) < 2**31 else np.int64)
+        ids = np.arange(len(words))
+        pos = np.fromiter(map(zlib.crc32, words), dtype=np.int64, count=len(words)) & (size - 1)
+        while len(ids):
+            # Words whose slot is empty go there, the first one if several
+            # have the same slot, others try the next slot
+            empty = table[pos] < 0
+            _, first = np.unique(pos[empty], return_index=True)
+            placed = np.flatnonzero(empty)[first]
+            table[pos[placed]] = ids[placed]
+            left = np.ones(len(ids), dtype=bool)
+            left[placed] = False
+            ids, pos = ids[left], (pos[left] + 1) & (size - 1)
+        blob = np.frombuffer(b'\n'.join(words), dtype=np.uint8)
+        return cls(blob, offsets, table)
+
+    def to_arrays(self) -> dict:
+        return {'vocab': self.blob, 'vocab_offsets': self.offsets, 'vocab_table': self.table}
+
+    def to_vocabulary(self) -> Vocabulary:
+        '''
+        Vocabulary of the same words and ids, to add words to
+        '''
+        return Vocabulary.from_bytes(self.blob)
+
+    def word_at(self, i: int) -> bytes:
+        return self.blob_view[self.offsets_view[i] : self.offsets_view[i + 1] - 1].tobytes()
+
+    def get(self, word, default=-1) -> int:
+        i = self.cache.get(word)
+        if i is None:
+            data = word.encode('utf8')
+            i = self.probe(data, zlib.crc32(data) & self.mask, -1)
+            self.add_to_cache([word], [i])
+        return default if i < 0 else i
+
+    def add_to_cache(self, words: list, ids: list) -> None:
+        if len(self.cache) + len(words) > self.CACHE_SIZE:
+            self.cache.clear()
+        self.cache.update(zip(words, ids))
+
+    def probe(self, word: bytes, pos: int, default) -> int:
+        '''
+        Id of `word`, looking for it from slot `pos` on
+        '''
+        while True:
+            i = self.table_view[pos]
+            if i < 0:
+                return default
+            if self.word_at(i) == word:
+                return i
+            pos = (pos + 1) & self.mask
+
+    def lookup(self, words, default=-1) -> np.ndarray:
+        '''
+        Return array of ids of `words` (any iterable), `default` for
+        words not in vocab.
+        '''
+        words = list(words)
+        # -2 for words not in cache
+        ids = np.fromiter(
+            map(self.cache.get, words, repeat(-2)), dtype=np.int64, count=len(words))
+        if not len(ids) or ids.min() >= 0:
+            return ids
+        missed = np.flatnonzero(ids == -2)
+        if len(missed):
+            missed_words = [words[k] for k in missed.tolist()]
+            found = self.find(missed_words)
+            ids[missed] = found
+            self.add_to_cache(missed_words, found.tolist())
+        if default != -1:
+            ids[ids < 0] = default
+        return ids
+
+    def find(self, words: list) -> np.ndarray:
+        '''
+        lookup() in the hash table, -1 for words not in vocab
+        '''
+        words = [word.encode('utf8') for word in words]
+        n = len(words)
+        lens = np.fromiter(map(len, words), dtype=np.int64, count=n)
+        starts = np.cumsum(lens) - lens
+        buf = np.frombuffer(b''.join(words), dtype=np.uint8)
+        pos = np.fromiter(map(zlib.crc32, words), dtype=np.int64, count=n) & self.mask
+        result = np.full(n, -1, dtype=np.int64)
+        todo = np.arange(n)  # words whose slots are still probed
+        while len(todo) >= self.PROBE_ONE_BELOW:
+            ids = self.table[pos]
+            # Words of the same length as those in their slots, then those
+            # with the same bytes
+            cand = np.flatnonzero(ids >= 0)
+            cand_ids = ids[cand]
+            word_starts = self.offsets[cand_ids]
+            same_len = self.offsets[cand_ids + 1] - 1 - word_starts == lens[todo[cand]]
+            cand, cand_ids, word_starts = cand[same_len], cand_ids[same_len], word_starts[same_len]
+            cand_lens = lens[todo[cand]]
+            seg = np.repeat(np.arange(len(cand)), cand_lens)
+            rel = np.arange(len(seg)) - (np.cumsum(cand_lens) - cand_lens)[seg]
+            diff = buf[starts[todo[cand]][seg] + rel] != self.blob[word_starts[seg] + rel]
+            match = np.bincount(seg, diff, minlength=len(cand)) == 0
+            result[todo[cand[match]]] = cand_ids[match]
+            # Go on with the next slot unless empty or matched
+            left = ids >= 0
+            left[cand[match]] = False
+            todo, pos = todo[left], (pos[left] + 1) & self.mask
+        for k, p in zip(todo.tolist(), pos.tolist()):
+            result[k] = self.probe(words[k], p, -1)
+        return result
+
+    def __getitem__(self, word) -> int:
+        i = self.get(word)
+        if i < 0:
+            raise KeyError(word)
+        return i
+
+    def __contains__(self, word) -> bool:
+        return self.get(word) >= 0
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return iter(self.to_bytes().decode('utf8').split('\n') if len(self) else ())
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.blob)
+
+    def __reduce__(self):
+        # Memoryviews can't be pickled, they are made again from the arrays
+        return MappedVocabulary, (self.blob, self.offsets, self.table)
+
+
+class HashedVocabulary:
+    '''
+    Maps each word to one of `num_buckets` ids by a hash of the word (the
+    hashing trick), so arrays indexed by id have a fixed size whatever the
+    number of distinct words. Words in the same bucket share their counts.
+    Same interface as Vocabulary, every word is in the vocab and no word
+    is stored.
+    '''
+    def __init__(self, num_buckets: int):
+        self.num_buckets = num_buckets
+
+    def add(self, word) -> int:
+        return self.get(word)
+
+    def get(self, word, default=-1) -> int:
+        # crc32, unlike hash(), is the same in every process
+        return zlib.crc32(word.encode('utf8')) % self.num_buckets
+
+    def lookup(self, words, default=-1) -> np.ndarray:
+        hashes = np.fromiter(
+            (zlib.crc32(word.encode('utf8')) for word in words), dtype=np.int64)
+        return hashes % self.num_buckets
+
+    def __getitem__(self, word) -> int:
+        return self.get(word)
+
+    def __contains__(self, word) -> bool:
+        return True
+
+    def __len__(self) -> int:
+        return self.num_buckets
+
+    def to_bytes(self) -> bytes:
+        return b''
+
+    def to_arrays(self) -> dict:
+        return {'vocab': np.zeros(0, dtype=np.uint8)}